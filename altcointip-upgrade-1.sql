@@ -0,0 +1,10 @@
+-- Adds indexes used by check_action() and get_actions() to an existing t_action table.
+-- New installs get them from altcointip.sql and don't need this file.
+--
+-- On MySQL 5.6+ the indexes are built online (ALGORITHM=INPLACE, LOCK=NONE), so the bot can keep running.
+
+ALTER TABLE `t_action`
+  ADD KEY `to_user_state` (`to_user`,`state`,`type`),
+  ADD KEY `from_user_to_user_state_coin` (`from_user`,`to_user`,`state`,`coin`),
+  ADD KEY `type_state_created_utc` (`type`,`state`,`created_utc`),
+  ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,15 @@
+-- Adds t_user_totals table holding completed tip totals of each user, kept up to date by CtbAction.save().
+-- New installs get it from altcointip.sql and don't need this file.
+--
+-- Stop the bot, run this file, then fill the table from t_action with "python _user_totals.py rebuild" in src/.
+
+CREATE TABLE IF NOT EXISTS `t_user_totals` (
+  `username` varchar(30) NOT NULL,
+  `direction` enum('tipped','received') NOT NULL,
+  `coin` varchar(3) NOT NULL DEFAULT '',
+  `fiat` varchar(3) NOT NULL DEFAULT '',
+  `total_coin` double NOT NULL DEFAULT '0',
+  `total_fiat` double NOT NULL DEFAULT '0',
+  `num` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`username`,`direction`,`coin`,`fiat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -0,0 +1,10 @@
+-- Adds t_wiki_pages table holding hash of content last published to each stats wiki page, so unchanged pages aren't published again.
+-- New installs get it from altcointip.sql and don't need this file.
+
+CREATE TABLE IF NOT EXISTS `t_wiki_pages` (
+  `subreddit` varchar(30) NOT NULL,
+  `page` varchar(64) NOT NULL,
+  `hash` char(40) NOT NULL,
+  `updated_utc` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`subreddit`,`page`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
@@ -17,7 +17,33 @@ CREATE TABLE IF NOT EXISTS `t_action` (
   `msg_id` varchar(10) NOT NULL,
   `msg_link` varchar(200) DEFAULT NULL,
   PRIMARY KEY (`type`,`created_utc`,`msg_id`),
-  UNIQUE KEY `msg_id` (`msg_id`)
+  UNIQUE KEY `msg_id` (`msg_id`),
+  KEY `to_user_state` (`to_user`,`state`,`type`),
+  KEY `from_user_to_user_state_coin` (`from_user`,`to_user`,`state`,`coin`),
+  KEY `type_state_created_utc` (`type`,`state`,`created_utc`),
+  KEY `from_user_created_utc` (`from_user`,`created_utc`),
+  KEY `to_user_created_utc` (`to_user`,`created_utc`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `t_action_archive` (
+  `type` enum('givetip','withdraw','info','register','accept','decline','history','redeem','rates') NOT NULL,
+  `state` enum('completed','pending','failed','declined','expired') NOT NULL,
+  `created_utc` int(11) unsigned NOT NULL,
+  `from_user` varchar(30) NOT NULL,
+  `to_user` varchar(30) DEFAULT NULL,
+  `to_addr` varchar(34) DEFAULT NULL,
+  `coin_val` float unsigned DEFAULT NULL,
+  `fiat_val` float unsigned DEFAULT NULL,
+  `txid` varchar(64) DEFAULT NULL,
+  `coin` varchar(3) DEFAULT NULL,
+  `fiat` varchar(3) DEFAULT NULL,
+  `subreddit` varchar(30) DEFAULT NULL,
+  `msg_id` varchar(10) NOT NULL,
+  `msg_link` varchar(200) DEFAULT NULL,
+  PRIMARY KEY (`type`,`created_utc`,`msg_id`),
+  UNIQUE KEY `archive_msg_id` (`msg_id`),
+  KEY `archive_from_user_created_utc` (`from_user`,`created_utc`),
+  KEY `archive_to_user_created_utc` (`to_user`,`created_utc`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
 CREATE TABLE IF NOT EXISTS `t_addrs` (
@@ -28,6 +54,17 @@ CREATE TABLE IF NOT EXISTS `t_addrs` (
   UNIQUE KEY `address` (`address`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+CREATE TABLE IF NOT EXISTS `t_user_totals` (
+  `username` varchar(30) NOT NULL,
+  `direction` enum('tipped','received') NOT NULL,
+  `coin` varchar(3) NOT NULL DEFAULT '',
+  `fiat` varchar(3) NOT NULL DEFAULT '',
+  `total_coin` double NOT NULL DEFAULT '0',
+  `total_fiat` double NOT NULL DEFAULT '0',
+  `num` int(11) NOT NULL DEFAULT '0',
+  PRIMARY KEY (`username`,`direction`,`coin`,`fiat`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
 CREATE TABLE IF NOT EXISTS `t_users` (
   `username` varchar(30) NOT NULL,
   `joindate` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
@@ -35,8 +72,23 @@ CREATE TABLE IF NOT EXISTS `t_users` (
   PRIMARY KEY (`username`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 
+CREATE TABLE IF NOT EXISTS `t_schema` (
+  `version` int(11) NOT NULL,
+  `name` varchar(64) NOT NULL,
+  `applied_utc` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`version`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
 CREATE TABLE IF NOT EXISTS `t_values` (
   `param0` varchar(64) NOT NULL,
   `value0` int(11) NOT NULL DEFAULT '0',
   PRIMARY KEY (`param0`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+
+CREATE TABLE IF NOT EXISTS `t_wiki_pages` (
+  `subreddit` varchar(30) NOT NULL,
+  `page` varchar(64) NOT NULL,
+  `hash` char(40) NOT NULL,
+  `updated_utc` int(11) unsigned NOT NULL,
+  PRIMARY KEY (`subreddit`,`page`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
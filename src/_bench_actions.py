@@ -0,0 +1,104 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmark check_action() and get_actions() queries on a large t_action table
+
+# * Creates a scratch table t_action_bench (same structure as t_action) and fills it with ROWS random actions
+# * Times each query pattern without and with the t_action secondary indexes
+# * Drops t_action_bench when done; t_action itself is not touched
+# * Usage: "python _bench_actions.py [ROWS]" (default 2000000)
+
+import cointipbot, logging, random, sys, time
+from ctb import ctb_action
+
+TABLE = 't_action_bench'
+INDEXES = {'to_user_state': '`to_user`,`state`,`type`',
+           'from_user_to_user_state_coin': '`from_user`,`to_user`,`state`,`coin`',
+           'type_state_created_utc': '`type`,`state`,`created_utc`'}
+TYPES = ['givetip'] * 6 + ['info', 'register', 'withdraw', 'history', 'rates', 'accept', 'decline', 'redeem']
+STATES = ['completed'] * 8 + ['failed', 'expired', 'declined', 'pending']
+COINS = ['btc', 'dog', 'ltc']
+USERS = 50000
+REPEAT = 50
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.INFO)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+def user():
+    return 'user%d' % random.randint(1, USERS)
+
+def fill():
+    print "Filling %s with %s rows..." % (TABLE, rows)
+    sql = "INSERT INTO " + TABLE + " (type, state, created_utc, from_user, to_user, coin, coin_val, msg_id, msg_link) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+    now = int(time.time())
+    batch = []
+    for i in range(rows):
+        batch.append((random.choice(TYPES), random.choice(STATES), now - random.randint(0, 86400 * 365), user(), user(), random.choice(COINS), random.random() * 100, '%x' % i, None))
+        if len(batch) >= 10000:
+            ctb.db.execute(sql, batch)
+            batch = []
+    if batch:
+        ctb.db.execute(sql, batch)
+
+def queries():
+    """
+    Return list of (name, (sql, params)) to time, one per access pattern
+    """
+    q = []
+    for i in range(REPEAT):
+        q.append(('accept/decline: to_user, state', ctb_action.action_query(ctb_action.ACTION_COLUMNS, atype='givetip', state='pending', to_user=user(), table=TABLE)))
+        q.append(('givetip: from_user, to_user, state, coin', ctb_action.action_query(['msg_id'], atype='givetip', state='pending', from_user=user(), to_user=user(), coin=random.choice(COINS), table=TABLE)))
+        q.append(('expire: type, state, created_utc', ctb_action.action_query(ctb_action.ACTION_COLUMNS, atype='givetip', state='pending', created_utc='< %d' % (time.time() - 86400 * 364), table=TABLE)))
+        q.append(('duplicate: msg_id', ctb_action.action_query(['msg_id'], msg_id='%x' % random.randint(0, rows), table=TABLE)))
+    return q
+
+def run(label, q):
+    totals = {}
+    for name, (sql, params) in q:
+        t = time.time()
+        ctb.db.execute(sql, params).fetchall()
+        totals[name] = totals.get(name, 0.0) + time.time() - t
+    for name, (sql, params) in q[:4]:
+        plan = ctb.db.execute("EXPLAIN " + sql, params).fetchone()
+        print "%-12s %-45s %8.2f ms/query  key=%s rows=%s" % (label, name, totals[name] * 1000.0 / REPEAT, plan['key'], plan['rows'])
+
+try:
+    ctb.db.execute("DROP TABLE IF EXISTS " + TABLE)
+    ctb.db.execute("CREATE TABLE " + TABLE + " LIKE t_action")
+    for i in INDEXES:
+        try:
+            ctb.db.execute("ALTER TABLE " + TABLE + " DROP KEY " + i)
+        except Exception:
+            pass
+    fill()
+
+    q = queries()
+    run('no indexes', q)
+
+    print "Adding indexes..."
+    t = time.time()
+    ctb.db.execute("ALTER TABLE " + TABLE + " " + ', '.join(["ADD KEY `%s` (%s)" % (i, INDEXES[i]) for i in sorted(INDEXES)]))
+    print "Added in %.1f s" % (time.time() - t)
+    run('indexes', q)
+
+finally:
+    ctb.db.execute("DROP TABLE IF EXISTS " + TABLE)
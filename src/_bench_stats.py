@@ -0,0 +1,115 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Benchmark rendering of the tips wiki page table
+
+# * Renders ROWS random tips with the columns of db.sql.tips.sql_list, without touching database or Reddit
+# * Compares per-cell formatting with k.find() type checks and string concatenation (how update_tips()
+#   used to build the page, copied below as it was) against ctb_stats.render_table()
+# * Usage: "python _bench_stats.py [ROWS]" (default 50000)
+
+import cointipbot, logging, random, re, sys, time
+from ctb import ctb_stats
+
+rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.WARNING)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=False, init_logging=False)
+
+keys = ['num', 'created_utc', 'from_user', 'to_user', 'coin_val', 'coin', 'fiat_val', 'fiat', 'subreddit', 'msg_link']
+coins = [c for c in vars(ctb.conf.coins)]
+fiat = [f for f in vars(ctb.conf.fiat)]
+tips = []
+for i in range(rows):
+    tips.append({'num': i + 1,
+                 'created_utc': int(time.time()) - random.randint(0, 86400 * 365),
+                 'from_user': 'user%d' % random.randint(1, 5000),
+                 'to_user': 'user%d' % random.randint(1, 5000),
+                 'coin_val': random.random() * 1000,
+                 'coin': random.choice(coins),
+                 'fiat_val': random.random() * 10,
+                 'fiat': random.choice(fiat),
+                 'subreddit': 'dogecoin',
+                 'msg_link': 'http://www.reddit.com/r/dogecoin/comments/1abcde/title/cf%05d' % i})
+
+def legacy_format_value(m, k, username, ctb, compact=False):
+    # ctb_stats.format_value() before per-column formatters (format_value() now uses them too)
+    if not m[k]:
+        return '-'
+    if type(m[k]) == float and k.find("coin") > -1:
+        coin_symbol = ctb.conf.coins[m['coin']].symbol
+        return "%s&nbsp;%.5g" % (coin_symbol, m[k])
+    elif type(m[k]) == float and ( k.find("fiat") > -1 or k.find("usd") > -1 ):
+        fiat_symbol = ctb.conf.fiat[m['fiat']].symbol
+        return "%s&nbsp;%.2f" % (fiat_symbol, m[k])
+    elif k.find("user") > -1 and type( m[k] ) in [str, unicode]:
+        if compact:
+            return ("**/u/%s**" % m[k]) if m[k].lower() == username.lower() else ("/u/%s" % m[k])
+        else:
+            un = ("**%s**" % m[k]) if m[k].lower() == username.lower() else m[k]
+            toreturn = "[%s](/u/%s)" % (un, re.escape(m[k]))
+            if m[k].lower() != username.lower():
+                toreturn += "^[[stats]](/r/%s/wiki/%s_%s)" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page, m[k])
+            return toreturn
+    elif k.find("addr") > -1:
+        displayaddr = m[k][:6] + "..." + m[k][-5:]
+        return "[%s](%s%s)" % (displayaddr, ctb.conf.coins[m['coin']].explorer.address, m[k])
+    elif k.find("state") > -1:
+        if m[k] == 'completed':
+            return u'\u2713'
+        else:
+            return m[k]
+    elif k.find("type") > -1:
+        if m[k] == 'givetip':
+            return 'tip'
+        if compact:
+            if m[k] == 'withdraw':
+                return 'w'
+            if m[k] == 'redeem':
+                return 'r'
+    elif k.find("subreddit") > -1:
+        return "/r/%s" % m[k]
+    elif k.find("link") > -1:
+        return "[link](%s)" % m[k]
+    elif k.find("utc") > -1:
+        return "%s" % time.strftime('%Y-%m-%d', time.localtime(m[k]))
+    else:
+        return str(m[k])
+
+def legacy():
+    tip_list = "### All Completed Tips\n\n"
+    tip_list += ("|".join(keys)) + "\n"
+    tip_list += ("|".join([":---"] * len(keys))) + "\n"
+    for t in tips:
+        values = []
+        for k in keys:
+            values.append(legacy_format_value(t, k, '', ctb))
+        tip_list += ("|".join(values)) + "\n"
+    return tip_list
+
+def streaming():
+    tip_list = ["### All Completed Tips\n\n"]
+    ctb_stats.render_table(tip_list, tips, keys, '', ctb)
+    return ''.join(tip_list)
+
+for name, func in [('k.find + concatenation', legacy), ('render_table', streaming)]:
+    t = time.time()
+    page = func()
+    print "%-30s %8.3f s  (%s rows, %s bytes)" % (name, time.time() - t, rows, len(page))
@@ -0,0 +1,44 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Show or apply schema migrations (ctb_db.MIGRATIONS)
+
+# * "python _migrate.py status" lists migrations and whether each is applied
+# * "python _migrate.py up [VERSION]" applies pending migrations, up to VERSION if given
+# * Indexes and columns are added online where the database supports it, so CointipBot can keep running
+# * Set migrate_on_start to false in db.yml to apply migrations only with this script
+
+import cointipbot, logging, sys, time
+from ctb import ctb_db
+
+if not len(sys.argv) in [2, 3] or not sys.argv[1] in ['status', 'up']:
+        print "Usage: %s status|up [VERSION]" % sys.argv[0]
+        sys.exit(1)
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.INFO)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+if sys.argv[1] == 'up':
+    applied = ctb_db.migrate(ctb.db, target=int(sys.argv[2]) if len(sys.argv) == 3 else None)
+    print "%s migrations applied" % len(applied)
+
+done = ctb_db.applied_migrations(ctb.db)
+for version, name, func in ctb_db.MIGRATIONS:
+    print "%3s %-20s %s" % (version, name, time.strftime('applied %Y-%m-%d %H:%M:%S UTC', time.gmtime(done[version])) if done.has_key(version) else 'pending')
@@ -32,6 +32,9 @@ lg.debug(result)
 result = ctb_stats.update_tips(ctb=ctb)
 lg.debug(result)
 
+# Report how many pages were unchanged and not published again
+lg.info("Wiki pages written: %s, skipped as unchanged: %s, failed: %s", ctb_stats.wiki_counts['written'], ctb_stats.wiki_counts['skipped'], ctb_stats.wiki_counts['failed'])
+
 # This isn't needed because it happens during the tip processing
 #result = ctb_stats.update_all_user_stats(ctb=ctb)
 #lg.debug(result)
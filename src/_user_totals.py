@@ -0,0 +1,45 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Rebuild or verify t_user_totals, the per-user tip totals kept up to date by CtbAction.save()
+
+# * "python _user_totals.py verify" compares t_user_totals with totals computed from t_action
+# * "python _user_totals.py rebuild" recomputes t_user_totals from t_action (stop CointipBot first)
+
+import cointipbot, logging, sys
+from ctb import ctb_stats
+
+if not len(sys.argv) == 2 or not sys.argv[1] in ['rebuild', 'verify']:
+        print "Usage: %s rebuild|verify" % sys.argv[0]
+        sys.exit(1)
+
+logging.basicConfig()
+lg = logging.getLogger('cointipbot')
+lg.setLevel(logging.INFO)
+
+ctb = cointipbot.CointipBot(self_checks=False, init_reddit=False, init_coins=False, init_exchanges=False, init_db=True, init_logging=False)
+
+if sys.argv[1] == 'rebuild':
+    rows = ctb_stats.rebuild_user_totals(ctb=ctb)
+    print "t_user_totals rebuilt (%s rows)" % rows
+
+else:
+    diffs = ctb_stats.verify_user_totals(ctb=ctb)
+    for d in diffs:
+        print "%s %s %s %s: expected %s, found %s" % d
+    print "%s differences" % len(diffs)
+    sys.exit(1 if diffs else 0)
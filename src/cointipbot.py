@@ -16,9 +16,10 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from ctb import ctb_action, ctb_coin, ctb_db, ctb_exchange, ctb_log, ctb_misc, ctb_user, simulated_reddit
+from ctb import ctb_action, ctb_coin, ctb_db, ctb_exchange, ctb_log, ctb_misc, ctb_stats, ctb_user, simulated_reddit
 
-import gettext, locale, logging, praw, smtplib, sys, time, traceback, yaml
+import Queue, gettext, locale, logging, praw, smtplib, sys, threading, time, traceback, yaml
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from jinja2 import Environment, PackageLoader
 
@@ -42,7 +43,15 @@ class CointipBot(object):
     coins = {}
     exchanges = {}
     jenv = None
-    runtime = {'ev': {}, 'regex': []}
+    runtime = {'rates': {'ev': {}, 'ev_time': {}, 'tickers': {}, 'refreshed': 0}, 'regex': []}
+    # Users are locked through a fixed set of striped locks, so memory use doesn't grow with number of users
+    user_locks = [threading.RLock() for i in range(64)]
+    seen = None
+    deferred = None
+    user_stats = None
+    banned = None
+    users = None
+    addrs = None
 
     def init_logging(self):
         """
@@ -110,11 +119,8 @@ class CointipBot(object):
         """
         lg.debug('CointipBot::connect_db(): connecting to database...')
 
-        if self.test:
-            dsn = "mysql+mysqldb://%s:%s@%s:%s/%s?charset=utf8" % (self.conf.db.auth.user, self.conf.db.auth.password, self.conf.db.auth.host, self.conf.db.auth.port, self.conf.db.auth.test_dbname)
-        else:
-            dsn = "mysql+mysqldb://%s:%s@%s:%s/%s?charset=utf8" % (self.conf.db.auth.user, self.conf.db.auth.password, self.conf.db.auth.host, self.conf.db.auth.port, self.conf.db.auth.dbname)
-        dbobj = ctb_db.CointipBotDatabase(dsn)
+        dsn = ctb_db.dsn(self.conf.db, test=self.test)
+        dbobj = ctb_db.CointipBotDatabase(dsn, pool=dict(vars(self.conf.db.pool)) if hasattr(self.conf.db, 'pool') else None)
 
         try:
             conn = dbobj.connect()
@@ -122,7 +128,11 @@ class CointipBot(object):
             lg.error("CointipBot::connect_db(): error connecting to database: %s", e)
             sys.exit(1)
 
-        lg.info("CointipBot::connect_db(): connected to database %s as %s", self.conf.db.auth.dbname, self.conf.db.auth.user)
+        # Bring schema of existing database up to date
+        if not hasattr(self.conf.db, 'migrate_on_start') or self.conf.db.migrate_on_start:
+            ctb_db.migrate(conn)
+
+        lg.info("CointipBot::connect_db(): connected to %s database %s", conn.dialect.name, conn.url.database)
         return conn
 
     def connect_reddit(self):
@@ -150,9 +160,12 @@ class CointipBot(object):
         if not b.is_registered():
             b.register()
 
-        # Ensure (total pending tips) < (CointipBot's balance)
         for c in self.coins:
-            ctb_balance = b.get_balance(coin=c, kind='givetip')
+            # Get CointipBot's balance and total wallet balance in one request
+            ctb_balance, total_balance = self.coins[c].conn.batch([('getbalance', b.name.lower(), self.conf.coins[c].minconf.givetip), ('getbalance',)])
+
+            # Ensure (total pending tips) < (CointipBot's balance)
+            ctb_balance = float(ctb_balance)
             pending_tips = float(0)
             actions = ctb_action.get_actions(atype='givetip', state='pending', coin=c, ctb=self)
             for a in actions:
@@ -160,11 +173,10 @@ class CointipBot(object):
             if (ctb_balance - pending_tips) < -0.000001:
                 raise Exception("CointipBot::self_checks(): CointipBot's %s balance (%s) < total pending tips (%s)" % (c.upper(), ctb_balance, pending_tips))
 
-        # Ensure coin balances are positive
-        for c in self.coins:
-            b = float(self.coins[c].conn.getbalance())
-            if b < 0:
-                raise Exception("CointipBot::self_checks(): negative balance of %s: %s" % (c, b))
+            # Ensure coin balances are positive
+            total_balance = float(total_balance)
+            if total_balance < 0:
+                raise Exception("CointipBot::self_checks(): negative balance of %s: %s" % (c, total_balance))
 
         # Ensure user accounts are intact and balances are not negative
         sql = "SELECT username FROM t_users ORDER BY username"
@@ -180,21 +192,96 @@ class CointipBot(object):
 
     def expire_pending_tips(self):
         """
-        Decline any pending tips that have reached expiration time limit
+        Decline any pending tips that have reached expiration time limit.
+        Refunds are aggregated per coin and tipper, and notifications and
+        stats updates are left to the deferred worker.
         """
 
         # Calculate timestamp
         seconds = int(self.conf.misc.times.expire_pending_hours * 3600)
         created_before = time.mktime(time.gmtime()) - seconds
-        counter = 0
 
-        # Get expired actions and decline them
-        for a in ctb_action.get_actions(atype='givetip', state='pending', created_utc='< ' + str(created_before), ctb=self):
-            a.expire()
-            counter += 1
+        # Get expired actions
+        actions = ctb_action.get_actions(atype='givetip', state='pending', created_utc='< ' + str(int(created_before)), ctb=self)
+        if not actions:
+            return False
+
+        # Claim tips before refunding, so a tip accepted or expired meanwhile isn't refunded
+        actions = ctb_action.set_actions_state(actions, 'expired', ctb=self, from_state='pending')
+        if not actions:
+            return False
+
+        # Add up refunds owed to each tipper, per coin
+        refunds = {}
+        for a in actions:
+            refunds.setdefault(a.coin, {})
+            refunds[a.coin][a.u_from.name.lower()] = refunds[a.coin].get(a.u_from.name.lower(), 0.0) + a.coinval
+
+        # Move coins back from CointipBot's account, one daemon request per coin
+        expired, failed, unknown = [], [], []
+        for c in refunds:
+            lg.info("CointipBot::expire_pending_tips(): refunding %s %s tips to %s users", len([a for a in actions if a.coin == c]), c.upper(), len(refunds[c]))
+            results = self.coins[c].sendtousers(_userfrom=self.conf.reddit.auth.user, _amounts=refunds[c])
+            for a in [a for a in actions if a.coin == c]:
+                result = results.get(a.u_from.name.lower())
+                if result:
+                    expired.append(a)
+                elif result == False:
+                    failed.append(a)
+                else:
+                    unknown.append(a)
+
+        # Refunds that definitely didn't happen are put back to pending, to be retried next time
+        if failed:
+            lg.error("CointipBot::expire_pending_tips(): %s of %s expired tips couldn't be refunded, leaving them pending", len(failed), len(actions))
+            ctb_action.set_actions_state(failed, 'pending', ctb=self, from_state='expired')
+
+        # Refunds that may or may not have happened stay expired, so they're never sent twice
+        for a in unknown:
+            lg.error("CointipBot::expire_pending_tips(): refund of %s %s to %s for tip %s may have failed, check manually", a.coinval, a.coin.upper(), a.u_from.name, a.msg.id if a.msg else a.deleted_msg_id)
+
+        if not expired:
+            return False
 
-        # Done
-        return (counter > 0)
+        # Notify tippers and update stats of everyone involved in background
+        for a in expired:
+            self.defer(a.notify_expired)
+            ctb_stats.queue_user_stats(ctb=self, username=a.u_from.name)
+            ctb_stats.queue_user_stats(ctb=self, username=a.u_to.name)
+
+        lg.info("CointipBot::expire_pending_tips(): expired %s tips", len(expired))
+        return True
+
+    def init_deferred_worker(self):
+        """
+        Start background thread running tasks passed to defer()
+        """
+
+        self.deferred = Queue.Queue()
+
+        def worker():
+            while True:
+                func, args, kwargs = self.deferred.get()
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    lg.error("CointipBot::init_deferred_worker(): %s failed: %s", func.__name__, e)
+                finally:
+                    self.deferred.task_done()
+
+        t = threading.Thread(target=worker, name='deferred')
+        t.daemon = True
+        t.start()
+
+    def defer(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in deferred worker thread, or right away if it isn't running
+        """
+
+        if self.deferred:
+            self.deferred.put((func, args, kwargs))
+        else:
+            func(*args, **kwargs)
 
     def check_inbox(self):
         """
@@ -209,60 +296,30 @@ class CointipBot(object):
             messages.reverse()
 
             # Process messages
-            for m in messages:
-                # Sometimes messages don't have an author (such as 'you are banned from' message)
-                if not m.author:
-                    lg.info("CointipBot::check_inbox(): ignoring msg with no author")
-                    ctb_misc.praw_call(m.mark_as_read)
-                    continue
-
-                lg.info("CointipBot::check_inbox(): %s from %s", "comment" if m.was_comment else "message", m.author.name)
-
-                # Ignore duplicate messages (sometimes Reddit fails to mark messages as read)
-                if ctb_action.check_action(msg_id=m.id, ctb=self):
-                    lg.warning("CointipBot::check_inbox(): duplicate action detected (msg.id %s), ignoring", m.id)
-                    ctb_misc.praw_call(m.mark_as_read)
-                    continue
-
-                # Ignore self messages
-                if m.author and m.author.name.lower() == self.conf.reddit.auth.user.lower():
-                    lg.debug("CointipBot::check_inbox(): ignoring message from self")
-                    ctb_misc.praw_call(m.mark_as_read)
-                    continue
-
-                # Ignore messages from banned users
-                if m.author and self.conf.reddit.banned_users:
-                    lg.debug("CointipBot::check_inbox(): checking whether user '%s' is banned..." % m.author)
-                    u = ctb_user.CtbUser(name = m.author.name, redditobj = m.author, ctb = self)
-                    if u.banned:
-                        lg.info("CointipBot::check_inbox(): ignoring banned user '%s'" % m.author)
-                        ctb_misc.praw_call(m.mark_as_read)
-                        continue
-
-                action = None
-                if m.was_comment:
-                    # Attempt to evaluate as comment / mention
-                    action = ctb_action.eval_comment(m, self)
-                else:
-                    # Attempt to evaluate as inbox message
-                    action = ctb_action.eval_message(m, self)
-
-                # Perform action, if found
-                if action:
-                    lg.info("CointipBot::check_inbox(): %s from %s (m.id %s)", action.type, action.u_from.name, m.id)
-                    lg.debug("CointipBot::check_inbox(): message body: <%s>", m.body)
-                    action.do()
-                else:
-                    lg.info("CointipBot::check_inbox(): no match")
-                    if self.conf.reddit.messages.sorry and not m.subject in ['post reply', 'comment reply']:
-                        user = ctb_user.CtbUser(name=m.author.name, redditobj=m.author, ctb=self)
-                        tpl = self.jenv.get_template('didnt-understand.tpl')
-                        msg = tpl.render(user_from=user.name, what='comment' if m.was_comment else 'message', source_link=m.permalink if hasattr(m, 'permalink') else None, ctb=self)
-                        lg.debug("CointipBot::check_inbox(): %s", msg)
-                        user.tell(subj='What?', msg=msg, msgobj=m if not m.was_comment else None)
-
-                # Mark message as read
-                ctb_misc.praw_call(m.mark_as_read)
+            workers = self.conf.reddit.scan.workers if hasattr(self.conf.reddit.scan, 'workers') else 1
+            if workers <= 1 or len(messages) <= 1:
+                for m in messages:
+                    self.check_message(m)
+
+            else:
+                # Messages from the same sender go to the same worker, in the order received
+                queues = [[] for i in range(workers)]
+                for m in messages:
+                    queues[hash(m.author.name.lower() if m.author else '') % workers].append(m)
+
+                errors = []
+                threads = []
+                for q in queues:
+                    if q:
+                        t = threading.Thread(target=self.check_messages, args=(q, errors))
+                        t.start()
+                        threads.append(t)
+                for t in threads:
+                    t.join()
+
+                # Re-raise first exception encountered by a worker
+                if errors:
+                    raise errors[0][0], errors[0][1], errors[0][2]
 
         except (HTTPError, ConnectionError, Timeout, RateLimitExceeded, timeout) as e:
             lg.warning("CointipBot::check_inbox(): Reddit is down (%s), sleeping", e)
@@ -275,6 +332,100 @@ class CointipBot(object):
         lg.debug("< CointipBot::check_inbox() DONE")
         return True
 
+    def check_messages(self, messages, errors):
+        """
+        Evaluate a list of inbox messages in order, stopping at the first
+        exception (which is appended to errors) or when another worker failed
+        """
+
+        for m in messages:
+            if errors:
+                return
+            try:
+                self.check_message(m)
+            except Exception:
+                errors.append(sys.exc_info())
+                return
+
+    def check_message(self, m):
+        """
+        Evaluate a single inbox message and mark it as read
+        """
+
+        # Sometimes messages don't have an author (such as 'you are banned from' message)
+        if not m.author:
+            lg.info("CointipBot::check_inbox(): ignoring msg with no author")
+            ctb_misc.praw_call(m.mark_as_read)
+            return
+
+        lg.info("CointipBot::check_inbox(): %s from %s", "comment" if m.was_comment else "message", m.author.name)
+
+        # Ignore duplicate messages (sometimes Reddit fails to mark messages as read)
+        if ctb_action.action_exists(msg_id=m.id, created_utc=m.created_utc, ctb=self):
+            lg.warning("CointipBot::check_inbox(): duplicate action detected (msg.id %s), ignoring", m.id)
+            ctb_misc.praw_call(m.mark_as_read)
+            return
+
+        # Ignore self messages
+        if m.author and m.author.name.lower() == self.conf.reddit.auth.user.lower():
+            lg.debug("CointipBot::check_inbox(): ignoring message from self")
+            ctb_misc.praw_call(m.mark_as_read)
+            return
+
+        # Ignore messages from banned users
+        if m.author and self.banned:
+            lg.debug("CointipBot::check_inbox(): checking whether user '%s' is banned..." % m.author)
+            if self.banned.is_banned(m.author.name):
+                lg.info("CointipBot::check_inbox(): ignoring banned user '%s'" % m.author)
+                ctb_misc.praw_call(m.mark_as_read)
+                return
+
+        action = None
+        if m.was_comment:
+            # Attempt to evaluate as comment / mention
+            action = ctb_action.eval_comment(m, self)
+        else:
+            # Attempt to evaluate as inbox message
+            action = ctb_action.eval_message(m, self)
+
+        # Perform action, if found
+        if action:
+            lg.info("CointipBot::check_inbox(): %s from %s (m.id %s)", action.type, action.u_from.name, m.id)
+            lg.debug("CointipBot::check_inbox(): message body: <%s>", m.body)
+            # Actions touching the same accounts never run concurrently
+            with self.lock_users(action.u_from.name, action.u_to.name if action.u_to else None):
+                action.do()
+        else:
+            lg.info("CointipBot::check_inbox(): no match")
+            if self.conf.reddit.messages.sorry and not m.subject in ['post reply', 'comment reply']:
+                user = ctb_user.get_user(name=m.author.name, redditobj=m.author, ctb=self)
+                tpl = self.jenv.get_template('didnt-understand.tpl')
+                msg = tpl.render(user_from=user.name, what='comment' if m.was_comment else 'message', source_link=m.permalink if hasattr(m, 'permalink') else None, ctb=self)
+                lg.debug("CointipBot::check_inbox(): %s", msg)
+                user.tell(subj='What?', msg=msg, msgobj=m if not m.was_comment else None)
+
+        # Mark message as read
+        ctb_misc.praw_call(m.mark_as_read)
+
+    @contextmanager
+    def lock_users(self, *names):
+        """
+        Hold a per-user lock for each given username. Locks are always taken
+        in the same (stripe index) order to avoid deadlocks between workers.
+        """
+
+        # Users sharing a stripe share its lock; take each stripe once, in index order
+        stripes = sorted(set([hash(n.lower()) % len(self.user_locks) for n in names if n]))
+        locks = [self.user_locks[i] for i in stripes]
+
+        for l in locks:
+            l.acquire()
+        try:
+            yield
+        finally:
+            for l in reversed(locks):
+                l.release()
+
     def init_subreddits(self):
         """
         Determine a list of subreddits and create a PRAW object
@@ -348,15 +499,14 @@ class CointipBot(object):
                     updated_last_processed_time = c.created_utc
 
                 # Ignore duplicate comments (may happen when bot is restarted)
-                if ctb_action.check_action(msg_id=c.id, ctb=self):
+                if ctb_action.action_exists(msg_id=c.id, created_utc=c.created_utc, ctb=self):
                     lg.warning("CointipBot::check_inbox(): duplicate action detected (comment.id %s), ignoring", c.id)
                     continue
 
                 # Ignore comments from banned users
-                if c.author and self.conf.reddit.banned_users:
+                if c.author and self.banned:
                     lg.debug("CointipBot::check_subreddits(): checking whether user '%s' is banned..." % c.author)
-                    u = ctb_user.CtbUser(name = c.author.name, redditobj = c.author, ctb = self)
-                    if u.banned:
+                    if self.banned.is_banned(c.author.name):
                         lg.info("CointipBot::check_subreddits(): ignoring banned user '%s'" % c.author)
                         continue
 
@@ -393,84 +543,152 @@ class CointipBot(object):
 
     def refresh_ev(self):
         """
-        Refresh coin/fiat exchange values using self.exchanges
+        Refresh coin/fiat exchange values using self.exchanges. A new snapshot
+        is built and swapped into self.runtime['rates'] once complete, holding
+        average values ('ev'), the time each was obtained ('ev_time'), values
+        returned by each exchange ('tickers') and time of refresh ('refreshed').
+        Values that couldn't be refreshed are carried over along with their old time.
         """
 
-        # Return if rate has been checked in the past hour
-        seconds = int(1 * 3600)
-        if hasattr(self.conf.exchanges, 'last_refresh') and self.conf.exchanges.last_refresh + seconds > int(time.mktime(time.gmtime())):
-            lg.debug("< CointipBot::refresh_ev(): DONE (skipping)")
-            return
+        now = time.time()
+        old = self.runtime['rates']
+        ev = dict((k, dict(v)) for k, v in old['ev'].items())
+        ev_time = dict((k, dict(v)) for k, v in old['ev_time'].items())
+
+        def assign(name1, name2, result):
+            if not ev.has_key(name1):
+                ev[name1] = {}
+                ev_time[name1] = {}
+            if result > 0.0:
+                ev[name1][name2] = result
+                ev_time[name1][name2] = now
+            elif not ev[name1].has_key(name2):
+                ev[name1][name2] = 0.0
+                ev_time[name1][name2] = 0
+            else:
+                lg.warning("CointipBot::refresh_ev(): couldn't refresh %s/%s, keeping value from %s", name1, name2, time.ctime(ev_time[name1][name2]))
+
+        # Pairs to look up: coin/BTC for each enabled coin, BTC/fiat for each enabled fiat
+        coin_pairs = {}
+        for c in vars(self.conf.coins):
+            if self.conf.coins[c].enabled and not self.conf.coins[c].unit == 'btc':
+                coin_pairs[c] = (self.conf.coins[c].unit, 'btc')
+        fiat_pairs = {}
+        for f in vars(self.conf.fiat):
+            if self.conf.fiat[f].enabled:
+                fiat_pairs[f] = ('btc', self.conf.fiat[f].unit)
+        pairs = coin_pairs.values() + fiat_pairs.values()
+
+        # Query all exchanges concurrently, each over its own connection
+        tickers = {}
+        def get_tickers(e):
+            tickers[e] = self.exchanges[e].get_ticker_values(_pairs=pairs)
+
+        threads = []
+        for e in self.exchanges:
+            t = threading.Thread(target=get_tickers, args=(e,))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+        def average(pair):
+            # Result is average of all responses, failed exchanges are left out
+            values = []
+            for e in tickers:
+                value = tickers[e].get(pair)
+                if value and float(value) > 0.0:
+                    values.append(float(value))
+            if len(values) > 0:
+                return sum(values) / float(len(values))
+            return 0.0
 
         # For each enabled coin...
         for c in vars(self.conf.coins):
             if self.conf.coins[c].enabled:
 
-                # Get BTC/coin exchange rate
-                values = []
-                result = 0.0
+                # Get BTC/coin exchange rate (BTC/BTC rate is always 1)
+                assign(c, 'btc', average(coin_pairs[c]) if coin_pairs.has_key(c) else 1.0)
 
-                if not self.conf.coins[c].unit == 'btc':
-                    # For each exchange that supports this coin...
-                    for e in self.exchanges:
-                        if self.exchanges[e].supports_pair(_name1=self.conf.coins[c].unit, _name2='btc'):
-                            # Get ticker value from exchange
-                            value = self.exchanges[e].get_ticker_value(_name1=self.conf.coins[c].unit, _name2='btc')
-                            if value and float(value) > 0.0:
-                                values.append(float(value))
+        # For each enabled fiat...
+        for f in fiat_pairs:
 
-                    # Result is average of all responses
-                    if len(values) > 0:
-                        result = sum(values) / float(len(values))
+            # Get fiat/BTC exchange rate
+            assign('btc', f, average(fiat_pairs[f]))
 
-                else:
-                    # BTC/BTC rate is always 1
-                    result = 1.0
+        # Swap in new snapshot, keeping values from each exchange for +rates
+        self.runtime['rates'] = {'ev': ev, 'ev_time': ev_time, 'tickers': tickers, 'refreshed': now}
+        lg.debug("CointipBot::refresh_ev(): %s", ev)
 
-                # Assign result to self.runtime['ev']
-                if not self.runtime['ev'].has_key(c):
-                    self.runtime['ev'][c] = {}
-                self.runtime['ev'][c]['btc'] = result
+    def init_ev_refresher(self):
+        """
+        Start a background thread refreshing exchange values every
+        conf.misc.times.ev_refresh_minutes
+        """
 
-        # For each enabled fiat...
-        for f in vars(self.conf.fiat):
-            if self.conf.fiat[f].enabled:
+        minutes = self.conf.misc.times.ev_refresh_minutes if hasattr(self.conf.misc.times, 'ev_refresh_minutes') else 60
 
-                # Get fiat/BTC exchange rate
-                values = []
-                result = 0.0
+        def refresher():
+            while True:
+                time.sleep(minutes * 60)
+                try:
+                    self.refresh_ev()
+                except Exception as e:
+                    lg.error("CointipBot::init_ev_refresher(): refresh failed: %s", e)
 
-                # For each exchange that supports this fiat...
-                for e in self.exchanges:
-                    if self.exchanges[e].supports_pair(_name1='btc', _name2=self.conf.fiat[f].unit):
-                        # Get ticker value from exchange
-                        value = self.exchanges[e].get_ticker_value(_name1='btc', _name2=self.conf.fiat[f].unit)
-                        if value and float(value) > 0.0:
-                            values.append(float(value))
+        t = threading.Thread(target=refresher, name='ev_refresher')
+        t.daemon = True
+        t.start()
+        lg.info("CointipBot::init_ev_refresher(): refreshing exchange values every %s minutes", minutes)
 
-                # Result is average of all responses
-                if len(values) > 0:
-                    result = sum(values) / float(len(values))
+    def init_archiver(self):
+        """
+        Start a background thread archiving old actions now and every
+        conf.db.archive.interval_hours, so a long first pass over t_action
+        doesn't hold up the deferred worker
+        """
 
-                # Assign result to self.runtime['ev']
-                if not self.runtime['ev'].has_key('btc'):
-                    self.runtime['ev']['btc'] = {}
-                self.runtime['ev']['btc'][f] = result
+        if not hasattr(self.conf.db, 'archive') or not self.conf.db.archive.enabled:
+            return
 
-        lg.debug("CointipBot::refresh_ev(): %s", self.runtime['ev'])
+        def archiver():
+            while True:
+                try:
+                    ctb_action.archive_actions(ctb=self, batch_size=self.conf.db.archive.batch_size)
+                except Exception as e:
+                    lg.error("CointipBot::init_archiver(): archiving failed: %s", e)
+                time.sleep(self.conf.db.archive.interval_hours * 3600)
 
-        # Update last_refresh
-        self.conf.exchanges.last_refresh = int(time.mktime(time.gmtime()))
+        t = threading.Thread(target=archiver, name='archiver')
+        t.daemon = True
+        t.start()
+        lg.info("CointipBot::init_archiver(): archiving old actions every %s hours", self.conf.db.archive.interval_hours)
 
     def coin_value(self, _coin, _fiat):
         """
-        Quick method to return _fiat value of _coin
+        Quick method to return _fiat value of _coin. Returns None if value is
+        unknown, or older than conf.misc.times.ev_max_age_hours and
+        conf.misc.times.ev_refuse_stale is set.
         """
+        rates = self.runtime['rates']
         try:
-            value = self.runtime['ev'][_coin]['btc'] * self.runtime['ev']['btc'][_fiat]
+            value = rates['ev'][_coin]['btc'] * rates['ev']['btc'][_fiat]
+            updated = min(rates['ev_time'][_coin]['btc'], rates['ev_time']['btc'][_fiat])
         except KeyError as e:
             lg.warning("CointipBot::coin_value(%s, %s): KeyError", _coin, _fiat)
-            value = 0.0
+            return None
+        if not value > 0.0:
+            return None
+
+        # Check age of exchange values
+        if hasattr(self.conf.misc.times, 'ev_max_age_hours'):
+            age = time.time() - updated
+            if age > self.conf.misc.times.ev_max_age_hours * 3600:
+                if hasattr(self.conf.misc.times, 'ev_refuse_stale') and self.conf.misc.times.ev_refuse_stale:
+                    lg.warning("CointipBot::coin_value(%s, %s): value is %d seconds old, refusing", _coin, _fiat, age)
+                    return None
+                lg.warning("CointipBot::coin_value(%s, %s): value is %d seconds old", _coin, _fiat, age)
+
         return value
 
     def notify(self, _msg=None):
@@ -511,12 +729,29 @@ class CointipBot(object):
         if init_logging:
             self.init_logging()
 
+        # Banned users
+        if self.conf.reddit.banned_users:
+            ttl = self.conf.reddit.banned_users.ttl_minutes * 60 if hasattr(self.conf.reddit.banned_users, 'ttl_minutes') else 3600
+            self.banned = ctb_user.CtbBannedUsers(ctb=self, ttl=ttl)
+
+        # Recently seen users
+        if hasattr(self.conf.misc, 'users'):
+            self.users = ctb_user.CtbUserMap(ctb=self, size=self.conf.misc.users.cache_size, ttl=dict(vars(self.conf.misc.users.ttl)))
+
         # Templating with jinja2
         self.jenv = Environment(trim_blocks=True, loader=PackageLoader('cointipbot', 'tpl/jinja2'))
 
         # Database
         if init_db:
             self.db = self.connect_db()
+            seen_size = self.conf.db.seen_cache.size if hasattr(self.conf.db, 'seen_cache') else 100000
+            seen_hours = self.conf.db.seen_cache.hours if hasattr(self.conf.db, 'seen_cache') else 72
+            self.seen = ctb_action.CtbMsgIdCache(size=seen_size, hours=seen_hours)
+
+        # Address to username index
+        if init_db:
+            addr_ttl = self.conf.misc.users.ttl.addr if hasattr(self.conf.misc, 'users') else 3600
+            self.addrs = ctb_user.CtbAddrIndex(ctb=self, ttl=addr_ttl)
 
         # Coins
         if init_coins:
@@ -553,7 +788,7 @@ class CointipBot(object):
         Return string representation of self
         """
         me = "<CointipBot: sleepsec=%s, batchlim=%s, ev=%s"
-        me = me % (self.conf.misc.times.sleep_seconds, self.conf.reddit.scan.batch_limit, self.runtime['ev'])
+        me = me % (self.conf.misc.times.sleep_seconds, self.conf.reddit.scan.batch_limit, self.runtime['rates']['ev'])
         return me
 
     def main(self):
@@ -561,19 +796,41 @@ class CointipBot(object):
         Main loop
         """
 
+        # Get exchange rate values, then keep them up to date in background
+        self.refresh_ev()
+        self.init_ev_refresher()
+
+        # Run notifications in background
+        self.init_deferred_worker()
+
+        # Rebuild stats pages of users involved in tips in background, at most once per interval
+        if self.conf.reddit.stats.enabled:
+            interval = self.conf.misc.times.stats_flush_seconds if hasattr(self.conf.misc.times, 'stats_flush_seconds') else 60
+            self.user_stats = ctb_stats.CtbUserStatsQueue(ctb=self, interval=interval)
+            self.user_stats.start()
+
+        # Load msg_ids of recent actions to answer duplicate checks without querying database
+        self.seen.warm(self.db)
+
+        # Archive old actions in background
+        self.init_archiver()
+
         while (True):
             try:
                 lg.debug("CointipBot::main(): beginning main() iteration")
 
-                # Refresh exchange rate values
-                self.refresh_ev()
-
                 # Expire pending tips first. fuck waiting for this shit.
                 self.expire_pending_tips()
 
                 # Check personal messages
                 self.check_inbox()
 
+                # Report time spent waiting on coin daemons and balance cache efficiency
+                for c in self.coins:
+                    lg.debug("CointipBot::main(): %s %s %s", c, self.coins[c].limiter, self.coins[c].balances)
+                    self.coins[c].balances.expire()
+                lg.debug("CointipBot::main(): %s", self.seen)
+
                 # Sleep
                 lg.debug("CointipBot::main(): sleeping for %s seconds...", self.conf.misc.times.sleep_seconds)
                 time.sleep(self.conf.misc.times.sleep_seconds)
@@ -15,9 +15,10 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import ctb_user, ctb_misc, ctb_stats
+import ctb_db, ctb_user, ctb_misc, ctb_stats
 
-import logging, praw, re, time
+import logging, praw, re, threading, time
+from collections import OrderedDict
 from random import randint
 
 lg = logging.getLogger('cointipbot')
@@ -70,8 +71,8 @@ class CtbAction(object):
         self.deleted_created_utc = deleted_created_utc
 
         self.addr_to = to_addr
-        self.u_to = ctb_user.CtbUser(name=to_user, ctb=ctb) if to_user else None
-        self.u_from = ctb_user.CtbUser(name=msg.author.name, redditobj=msg.author, ctb=ctb) if (msg and msg.author) else ctb_user.CtbUser(name=from_user, ctb=ctb)
+        self.u_to = ctb_user.get_user(name=to_user, ctb=ctb) if to_user else None
+        self.u_from = ctb_user.get_user(name=msg.author.name, redditobj=msg.author, ctb=ctb) if (msg and msg.author) else ctb_user.get_user(name=from_user, ctb=ctb)
         self.subreddit = subr
 
         # Do some checks
@@ -165,14 +166,16 @@ class CtbAction(object):
                 for c in sorted(self.ctb.coins):
                     lg.debug("CtbAction::__init__(atype=%s, from_user=%s): considering %s" % (self.type, self.u_from.name, c))
                     # First, check if we have a ticker value for this coin and fiat
-                    if not self.ctb.coin_value(cc[c].unit, self.fiat) > 0.0:
+                    value = self.ctb.coin_value(cc[c].unit, self.fiat)
+                    if not value:
                         continue
                     # Compare available and needed coin balances
                     coin_balance_avail = self.u_from.get_balance(coin=cc[c].unit, kind='givetip')
-                    coin_balance_need = self.fiatval / self.ctb.coin_value(cc[c].unit, self.fiat)
+                    coin_balance_need = self.fiatval / value
                     if coin_balance_avail > coin_balance_need or abs(coin_balance_avail - coin_balance_need) < 0.000001:
-                        # Found coin with enough balance
+                        # Found coin with enough balance, worth fiatval at the value just used
                         self.coin = cc[c].unit
+                        self.coinval = coin_balance_need
                         break
             if not self.coin:
                 # Couldn't deteremine coin, abort
@@ -185,11 +188,13 @@ class CtbAction(object):
                 # Set fiat to 'usd' if not specified
                 self.fiat = 'usd'
             if not self.fiatval:
-                # Determine fiat value
-                self.fiatval = self.coinval * self.ctb.coin_value(self.ctb.conf.coins[self.coin].unit, self.fiat)
+                # Determine fiat value (informational only, 0.0 if rates are unavailable)
+                self.fiatval = self.coinval * (self.ctb.coin_value(self.ctb.conf.coins[self.coin].unit, self.fiat) or 0.0)
             elif not self.coinval:
-                # Determine coin value
-                self.coinval = self.fiatval / self.ctb.coin_value(self.ctb.conf.coins[self.coin].unit, self.fiat)
+                # Determine coin value, left unset if rates are unavailable so validate() fails the action
+                value = self.ctb.coin_value(self.ctb.conf.coins[self.coin].unit, self.fiat)
+                if value:
+                    self.coinval = self.fiatval / value
 
         lg.debug("< CtbAction::__init__(atype=%s, from_user=%s) DONE", self.type, self.u_from.name)
 
@@ -223,46 +228,43 @@ class CtbAction(object):
             realmsgid=self.deleted_msg_id;
             realutc=self.deleted_created_utc;		
 
-        conn = self.ctb.db
-        sql = "REPLACE INTO t_action (type, state, created_utc, from_user, to_user, to_addr, coin_val, fiat_val, txid, coin, fiat, subreddit, msg_id, msg_link)"
-        sql += " values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-
+        row = {'type': self.type,
+               'state': state,
+               'created_utc': realutc,
+               'from_user': self.u_from.name.lower(),
+               'to_user': self.u_to.name.lower() if self.u_to else None,
+               'to_addr': self.addr_to,
+               'coin_val': self.coinval,
+               'fiat_val': self.fiatval,
+               'txid': self.txid,
+               'coin': self.coin,
+               'fiat': self.fiat,
+               'subreddit': self.subreddit,
+               'msg_link': self.msg.permalink if hasattr(self.msg, 'permalink') else None}
+
+        # Tip and its users' totals are saved together
         try:
-            mysqlexec = conn.execute(sql,
-                    (self.type,
-                     state,
-                     realutc,
-                     self.u_from.name.lower(),
-                     self.u_to.name.lower() if self.u_to else None,
-                     self.addr_to,
-                     self.coinval,
-                     self.fiatval,
-                     self.txid,
-                     self.coin,
-                     self.fiat,
-                     self.subreddit,
-                     realmsgid,
-                     self.msg.permalink if hasattr(self.msg, 'permalink') else None))
-            if mysqlexec.rowcount <= 0:
-                raise Exception("query didn't affect any rows")
+            with self.ctb.db.begin() as conn:
+                old = None
+                if self.type == 'givetip':
+                    old = conn.execute("SELECT state, from_user, to_user, coin, fiat, coin_val, fiat_val FROM t_action WHERE msg_id = %s" + ctb_db.for_update(conn), (realmsgid)).fetchone()
+
+                if ctb_db.upsert(conn, 't_action', key={'msg_id': realmsgid}, values=row) <= 0:
+                    raise Exception("query didn't affect any rows")
+
+                if old and old['state'] == 'completed':
+                    ctb_stats.add_user_totals(conn, from_user=old['from_user'], to_user=old['to_user'], coin=old['coin'], fiat=old['fiat'], coin_val=old['coin_val'], fiat_val=old['fiat_val'], sign=-1)
+                if self.type == 'givetip' and state == 'completed':
+                    # Add values as stored (t_action columns are single precision on MySQL), so totals match SUM() over t_action
+                    new = conn.execute("SELECT coin_val, fiat_val FROM t_action WHERE msg_id = %s", (realmsgid)).fetchone()
+                    ctb_stats.add_user_totals(conn, from_user=self.u_from.name, to_user=self.u_to.name if self.u_to else None, coin=self.coin, fiat=self.fiat, coin_val=new['coin_val'], fiat_val=new['fiat_val'])
         except Exception as e:
-            lg.error("CtbAction::save(%s): error executing query <%s>: %s", state, sql % (
-                self.type,
-                state,
-                self.msg.created_utc,
-                self.u_from.name.lower(),
-                self.u_to.name.lower() if self.u_to else None,
-                self.addr_to,
-                self.coinval,
-                self.fiatval,
-                self.txid,
-                self.coin,
-                self.fiat,
-                self.subreddit,
-                realmsgid,
-                self.msg.permalink if hasattr(self.msg, 'permalink') else None), e)
+            lg.error("CtbAction::save(%s): error saving action %s %s: %s", state, realmsgid, row, e)
             raise
 
+        if self.ctb.seen:
+            self.ctb.seen.add(realmsgid, realutc)
+
         lg.debug("< CtbAction::save() DONE")
         return True
 
@@ -290,9 +292,9 @@ class CtbAction(object):
 
         if self.type == 'givetip':
             result = self.givetip()
-            ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_from.name)
+            ctb_stats.queue_user_stats(ctb=self.ctb, username=self.u_from.name)
             if self.u_to:
-                ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_to.name)
+                ctb_stats.queue_user_stats(ctb=self.ctb, username=self.u_to.name)
             return result
 
         if self.type == 'history':
@@ -325,20 +327,29 @@ class CtbAction(object):
         Provide user with transaction history
         """
 
+        # "+history CURSOR" asks for actions older than those of a previous reply
+        cursor = None
+        if self.msg and self.msg.body:
+            m = re.search(r'\+history\s+(\d+_[a-z0-9]+)', self.msg.body, re.IGNORECASE)
+            if m:
+                cursor = m.group(1)
+
         # Generate history array
         history = []
-        sql_history = self.ctb.conf.db.sql.userhistory.sql
+        keys = self.ctb.conf.db.sql.userhistory.columns
         limit = int(self.ctb.conf.db.sql.userhistory.limit)
 
-        mysqlexec = self.ctb.db.execute(sql_history, (self.u_from.name.lower(), self.u_from.name.lower(), limit))
-        for m in mysqlexec:
-            history_entry = []
-            for k in mysqlexec.keys():
-                history_entry.append(ctb_stats.format_value(m, k, self.u_from.name.lower(), self.ctb, compact=True))
-            history.append(history_entry)
+        rows, next_cursor = ctb_stats.get_history(ctb=self.ctb, username=self.u_from.name, columns=keys, types=self.ctb.conf.db.sql.userhistory.types, limit=limit, cursor=cursor)
+        plan = ctb_stats.format_plan(keys, self.u_from.name.lower(), self.ctb, compact=True)
+        for m in rows:
+            history.append([f(m) for f in plan])
+
+        # Lifetime totals, precomputed in t_user_totals
+        totals = ctb_stats.get_user_totals(ctb=self.ctb, username=self.u_from.name)
 
         # Send message to user
-        msg = self.ctb.jenv.get_template('history.tpl').render(history=history, keys=mysqlexec.keys(), limit=limit, a=self, ctb=self.ctb)
+        older_url = ctb_stats.history_url(ctb=self.ctb, cursor=next_cursor) if next_cursor else None
+        msg = self.ctb.jenv.get_template('history.tpl').render(history=history, keys=keys, limit=limit, cursor=cursor, next_cursor=next_cursor, older_url=older_url, totals=totals, a=self, ctb=self.ctb)
         lg.debug("CtbAction::history(): %s", msg)
         ctb_misc.praw_call(self.msg.reply, msg)
         return True
@@ -363,8 +374,8 @@ class CtbAction(object):
             for a in actions:
                 a.givetip(is_pending=True)
                 # Update user stats
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_from.name)
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_to.name)
+                ctb_stats.queue_user_stats(ctb=a.ctb, username=a.u_from.name)
+                ctb_stats.queue_user_stats(ctb=a.ctb, username=a.u_to.name)
         else:
             # No pending actions found, reply with error message
             msg = self.ctb.jenv.get_template('no-pending-tips.tpl').render(user_from=self.u_from.name, a=self, ctb=self.ctb)
@@ -395,8 +406,8 @@ class CtbAction(object):
                 a.save('declined')
 
                 # Update user stats
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_from.name)
-                ctb_stats.update_user_stats(ctb=a.ctb, username=a.u_to.name)
+                ctb_stats.queue_user_stats(ctb=a.ctb, username=a.u_from.name)
+                ctb_stats.queue_user_stats(ctb=a.ctb, username=a.u_to.name)
 
                 # Respond to tip comment
                 msg = self.ctb.jenv.get_template('confirmation.tpl').render(title='Declined', a=a, ctb=a.ctb, source_link=a.msg.permalink if a.msg else None)
@@ -423,34 +434,21 @@ class CtbAction(object):
         lg.debug("< CtbAction::decline() DONE")
         return True
 
-    def expire(self):
+    def notify_expired(self):
         """
-        Expire a pending tip
+        Tell tipper that pending tip has expired
         """
-        lg.debug("> CtbAction::expire()")
+        lg.debug("> CtbAction::notify_expired()")
 
-        # Move coins back into self.u_from account
-        lg.info("CtbAction::expire(): moving %s %s from %s to %s", self.coinval, self.coin.upper(), self.ctb.conf.reddit.auth.user, self.u_from.name)
-        if not self.ctb.coins[self.coin].sendtouser(_userfrom=self.ctb.conf.reddit.auth.user, _userto=self.u_from.name, _amount=self.coinval):
-            raise Exception("CtbAction::expire(): sendtouser() failed")
-
-        # Save transaction as expired
-        self.save('expired')
-
-        # Update user stats
-        ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_from.name)
-        ctb_stats.update_user_stats(ctb=self.ctb, username=self.u_to.name)
-
-        # Respond to tip comment
         msg = self.ctb.jenv.get_template('confirmation.tpl').render(title='Expired', a=self, ctb=self.ctb, source_link=self.msg.permalink if self.msg else None)
-        lg.debug("CtbAction::expire(): " + msg)
+        lg.debug("CtbAction::notify_expired(): " + msg)
         if self.ctb.conf.reddit.messages.expired:
             if not ctb_misc.praw_call(self.msg.reply, msg):
                 self.u_from.tell(subj="+tip expired", msg=msg)
         else:
             self.u_from.tell(subj="+tip expired", msg=msg)
 
-        lg.debug("< CtbAction::expire() DONE")
+        lg.debug("< CtbAction::notify_expired() DONE")
         return True
 
     def validate(self, is_pending=False):
@@ -483,12 +481,26 @@ class CtbAction(object):
                 self.save('failed')
                 return False
 
+            # Verify that coin value could be determined from fiat value
+            if self.coinval == None:
+                msg = self.ctb.jenv.get_template('rates-unavailable.tpl').render(a=self, ctb=self.ctb)
+                lg.debug("CtbAction::validate(): %s", msg)
+                self.u_from.tell(subj="+tip failed", msg=msg)
+                self.save('failed')
+                return False
+
             # Verify that u_from has coin address
             if not self.u_from.get_addr(coin=self.coin):
                 lg.error("CtbAction::validate(): user %s doesn't have %s address", self.u_from.name, self.coin.upper())
                 self.save('failed')
                 raise Exception
 
+            # Note withdrawals to addresses of the bot's own users; they're still sent on-chain as requested
+            if self.addr_to and self.ctb.addrs:
+                owner = self.ctb.addrs.lookup(self.coin, self.addr_to)
+                if owner:
+                    lg.info("CtbAction::validate(): %s withdrawing to %s address %s, which belongs to %s", self.u_from.name, self.coin.upper(), self.addr_to, owner)
+
             # Verify minimum transaction size
             txkind = 'givetip' if self.u_to else 'withdraw'
             if self.coinval < self.ctb.conf.coins[self.coin].txmin[txkind]:
@@ -716,17 +728,17 @@ class CtbAction(object):
         fiat_total = 0.0
         for i in info:
             i.fiat_symbol = self.ctb.conf.fiat.usd.symbol
-            if self.ctb.coin_value(self.ctb.conf.coins[i.coin].unit, 'usd') > 0.0:
-                i.fiat_balance = i.balance * self.ctb.coin_value(self.ctb.conf.coins[i.coin].unit, 'usd')
+            value = self.ctb.coin_value(self.ctb.conf.coins[i.coin].unit, 'usd')
+            if value:
+                i.fiat_balance = i.balance * value
                 fiat_total += i.fiat_balance
 
-        # Get coin addresses from MySQL
+        # Get coin addresses
+        addrs = self.u_from.get_addrs()
         for i in info:
-            sql = "SELECT address FROM t_addrs WHERE username = '%s' AND coin = '%s'" % (self.u_from.name.lower(), i.coin)
-            mysqlrow = self.ctb.db.execute(sql).fetchone()
-            if not mysqlrow:
-                raise Exception("CtbAction::info(%s): no result from <%s>" % (self.u_from.name, sql))
-            i.address = mysqlrow['address']
+            if not addrs.has_key(i.coin):
+                raise Exception("CtbAction::info(%s): no %s address" % (self.u_from.name, i.coin))
+            i.address = addrs[i.coin]
 
         # Format and send message
         msg = self.ctb.jenv.get_template('info.tpl').render(info=info, fiat_symbol=self.ctb.conf.fiat.usd.symbol, fiat_total=fiat_total, a=self, ctb=self.ctb)
@@ -788,7 +800,7 @@ class CtbAction(object):
             return False
 
         # Check if this user has > minimum karma
-        user_karma = int(self.u_from.prawobj.link_karma) + int(self.u_from.prawobj.comment_karma)
+        user_karma = sum(self.u_from.get_karma())
         if user_karma < self.ctb.conf.reddit.redeem.min_karma:
             msg = self.ctb.jenv.get_template('redeem-low-karma.tpl').render(user_karma=user_karma, a=self, ctb=self.ctb)
             lg.debug("CtbAction::redeem(): %s", msg)
@@ -839,45 +851,76 @@ class CtbAction(object):
         exchanges = []
         rates = {}
 
-        # Get exchange rates
+        # Use exchange values collected by last refresh_ev()
+        snapshot = self.ctb.runtime['rates']
+        ev = snapshot['ev']
+        ev_time = snapshot['ev_time']
+        tickers = snapshot['tickers']
+        updated = []
+
         for coin in self.ctb.coins:
             coins.append(coin)
+            unit = self.ctb.conf.coins[coin].unit
             rates[coin] = {'average': {}}
-            rates[coin]['average']['btc'] = self.ctb.runtime['ev'][coin]['btc']
-            rates[coin]['average'][fiat] = self.ctb.runtime['ev'][coin]['btc'] * self.ctb.runtime['ev']['btc'][fiat]
+            try:
+                rates[coin]['average']['btc'] = ev[coin]['btc']
+                rates[coin]['average'][fiat] = ev[coin]['btc'] * ev['btc'][fiat]
+                # Averages are carried over when exchanges fail, so note when each was obtained
+                updated.append(min(ev_time[coin]['btc'], ev_time['btc'][fiat]))
+            except KeyError:
+                return self.rates_error()
+
             for exchange in self.ctb.exchanges:
-                try:
-                    rates[coin][exchange] = {}
-                    if self.ctb.exchanges[exchange].supports_pair(_name1=coin, _name2='btc'):
-                        rates[coin][exchange]['btc'] = self.ctb.exchanges[exchange].get_ticker_value(_name1=coin, _name2='btc')
-                        if coin == 'btc' and self.ctb.exchanges[exchange].supports_pair(_name1='btc', _name2=fiat):
-                            # Use exchange value to calculate btc's fiat value
-                            rates[coin][exchange][fiat] = rates[coin][exchange]['btc'] * self.ctb.exchanges[exchange].get_ticker_value(_name1='btc', _name2=fiat)
-                        else:
-                            # Use average value to calculate coin's fiat value
-                            rates[coin][exchange][fiat] = rates[coin][exchange]['btc'] * self.ctb.runtime['ev']['btc'][fiat]
-                    else:
-                        rates[coin][exchange]['btc'] = None
-                        rates[coin][exchange][fiat] = None
-                except TypeError as e:
-                    msg = self.ctb.jenv.get_template('rates-error.tpl').render(exchange=exchange, a=self, ctb=self.ctb)
-                    lg.debug("CtbAction::rates(): %s", msg)
-                    ctb_misc.praw_call(self.msg.reply, msg)
-                    self.save('failed')
-                    return False
+                rates[coin][exchange] = {'btc': None, fiat: None}
+                if not self.ctb.exchanges[exchange].supports_pair(_name1=unit, _name2='btc'):
+                    continue
+                # Exchanges that failed during last refresh are shown as '-'
+                values = tickers.get(exchange, {})
+                rates[coin][exchange]['btc'] = 1.0 if unit == 'btc' else values.get((unit, 'btc'))
+                if not rates[coin][exchange]['btc']:
+                    continue
+                if unit == 'btc' and self.ctb.exchanges[exchange].supports_pair(_name1='btc', _name2=fiat):
+                    # Use exchange value to calculate btc's fiat value
+                    if values.get(('btc', fiat)):
+                        rates[coin][exchange][fiat] = rates[coin][exchange]['btc'] * values.get(('btc', fiat))
+                else:
+                    # Use average value to calculate coin's fiat value
+                    rates[coin][exchange][fiat] = rates[coin][exchange]['btc'] * ev['btc'][fiat]
 
         for exchange in self.ctb.exchanges:
             exchanges.append(exchange)
 
         lg.debug("CtbAction::rates(): %s", rates)
 
+        # Rates are as old as the oldest average shown (values never obtained are shown as 0)
+        updated = [u for u in updated if u]
+        oldest = min(updated) if updated else 0
+        if not oldest:
+            return self.rates_error()
+        times = self.ctb.conf.misc.times
+        if hasattr(times, 'ev_max_age_hours') and time.time() - oldest > times.ev_max_age_hours * 3600:
+            if hasattr(times, 'ev_refuse_stale') and times.ev_refuse_stale:
+                lg.warning("CtbAction::rates(): rates are %d seconds old, refusing", time.time() - oldest)
+                return self.rates_error()
+
         # Send message
-        msg = self.ctb.jenv.get_template('rates.tpl').render(coins=sorted(coins), exchanges=sorted(exchanges), rates=rates, fiat=fiat, a=self, ctb=self.ctb)
+        msg = self.ctb.jenv.get_template('rates.tpl').render(coins=sorted(coins), exchanges=sorted(exchanges), rates=rates, fiat=fiat, refreshed=time.strftime('%Y-%m-%d %H:%M', time.gmtime(oldest)), a=self, ctb=self.ctb)
         lg.debug("CtbAction::rates(): %s", msg)
         ctb_misc.praw_call(self.msg.reply, msg)
         self.save('completed')
         return True
 
+    def rates_error(self):
+        """
+        Reply that exchange rates aren't available
+        """
+
+        msg = self.ctb.jenv.get_template('rates-error.tpl').render(exchange=', '.join(sorted(self.ctb.exchanges)), a=self, ctb=self.ctb)
+        lg.debug("CtbAction::rates(): %s", msg)
+        ctb_misc.praw_call(self.msg.reply, msg)
+        self.save('failed')
+        return False
+
 def init_regex(ctb):
     """
     Initialize regular expressions used to match messages and comments
@@ -1005,9 +1048,102 @@ def init_regex(ctb):
                     lg.debug("init_regex(): ADDED %s: %s", entry.action, entry.regex)
                     ctb.runtime['regex'].append(entry)
 
+    # Precompile expressions and determine literals each of them requires
+    units = {}
+    for c in vars(cc):
+        units[cc[c].unit] = cc[c].regex.units
+    for f in vars(fiat):
+        units[fiat[f].unit] = fiat[f].regex.units
+    for entry in ctb.runtime['regex']:
+        entry.compiled = re.compile(entry.regex, re.IGNORECASE|re.DOTALL)
+        entry.prefilter = init_prefilter(entry, units)
+
     lg.info("< init_regex() DONE (%s expressions)", len(ctb.runtime['regex']))
     return None
 
+def init_prefilter(entry, units):
+    """
+    Return a list of literal tuples required by entry.regex. Each tuple holds
+    lowercase alternatives, at least one of which must be present in a message
+    body for entry.regex to match it.
+    """
+
+    prefilter = []
+    if entry.regex.startswith('(\\+)'):
+        prefilter.append((u'+',))
+
+        # Leading group, such as '(withdraw)' or '(/u/mybotuser|mybotuser)'
+        m = re.match(r'\(\\\+\)(\([^()]*\))', entry.regex)
+        if m:
+            literals = regex_literals(m.group(1))
+            if literals:
+                prefilter.append(literals)
+
+    for u in [entry.coin, entry.fiat]:
+        if u and units.has_key(u):
+            literals = regex_literals(units[u])
+            if literals:
+                prefilter.append(literals)
+
+    return prefilter
+
+def regex_literals(group):
+    """
+    Return a tuple of lowercase literal alternatives of a group such as
+    '(doge|dogecoin)', or None if group isn't made of plain literals
+    """
+
+    if group.startswith('(') and group.endswith(')'):
+        group = group[1:-1]
+    if isinstance(group, str):
+        group = group.decode('utf-8')
+    if not group or group.find('\\|') > -1:
+        return None
+
+    literals = []
+    for alt in group.split('|'):
+        # Escaped punctuation (such as '\$') is a literal, anything else isn't
+        if not alt or re.search(r'[\\.^$*+?{}\[\]()]', re.sub(r'\\\W', '', alt)):
+            return None
+        literals.append(re.sub(r'\\(\W)', r'\1', alt).lower())
+
+    return tuple(literals)
+
+def match_regex(body, ctb, public=False):
+    """
+    Return (entry, match) for the first expression in ctb.runtime['regex']
+    matching body, or (None, None). Expressions whose required literals are
+    missing from body are skipped without running them.
+    """
+
+    lbody = body.decode('utf-8', 'replace') if isinstance(body, str) else body
+    lbody = lbody.lower()
+    present = {}
+
+    for r in ctb.runtime['regex']:
+
+        # Skip non-public actions
+        if public and not ctb.conf.regex.actions[r.action].public:
+            continue
+
+        # Cheap literal scan, results are shared among expressions
+        candidate = True
+        for literals in r.prefilter:
+            if not present.has_key(literals):
+                present[literals] = any(l in lbody for l in literals)
+            if not present[literals]:
+                candidate = False
+                break
+        if not candidate:
+            continue
+
+        # Attempt a match
+        m = r.compiled.search(body)
+        if m:
+            return (r, m)
+
+    return (None, None)
+
 def eval_message(msg, ctb):
     """
     Evaluate message body and return a CtbAction
@@ -1015,40 +1151,34 @@ def eval_message(msg, ctb):
     """
     lg.debug("> eval_message()")
 
-    body = msg.body
     #lg.info(vars(msg)) #debug
-    for r in ctb.runtime['regex']:
+    r, m = match_regex(msg.body, ctb)
 
-        # Attempt a match
-        rg = re.compile(r.regex, re.IGNORECASE|re.DOTALL)
-        #lg.debug("matching '%s' with '%s'", msg.body, r.regex)
-        m = rg.search(body)
+    if m:
+        # Match found
+        lg.debug("eval_message(): match found")
 
-        if m:
-            # Match found
-            lg.debug("eval_message(): match found")
-
-            # Extract matched fields into variables
-            to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
-            amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
-            keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
-            
-            if ((to_addr == None) and (r.action == 'givetip')):
-                lg.debug("eval_message(): can't tip with no to_addr")
-                return None
-
-            # Return CtbAction instance with given variables
-            return CtbAction(   atype=r.action,
-                                msg=msg,
-                                from_user=msg.author,
-                                to_user=None,
-                                to_addr=to_addr,
-                                coin=r.coin,
-                                coin_val=amount if not r.fiat else None,
-                                fiat=r.fiat,
-                                fiat_val=amount if r.fiat else None,
-                                keyword=keyword,
-                                ctb=ctb)
+        # Extract matched fields into variables
+        to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
+        amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
+        keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
+        
+        if ((to_addr == None) and (r.action == 'givetip')):
+            lg.debug("eval_message(): can't tip with no to_addr")
+            return None
+
+        # Return CtbAction instance with given variables
+        return CtbAction(   atype=r.action,
+                            msg=msg,
+                            from_user=msg.author,
+                            to_user=None,
+                            to_addr=to_addr,
+                            coin=r.coin,
+                            coin_val=amount if not r.fiat else None,
+                            fiat=r.fiat,
+                            fiat_val=amount if r.fiat else None,
+                            keyword=keyword,
+                            ctb=ctb)
 
     # No match found
     lg.debug("eval_message(): no match found")
@@ -1060,177 +1190,181 @@ def eval_comment(comment, ctb):
     """
     lg.debug("> eval_comment()")
 
-    body = comment.body
-    for r in ctb.runtime['regex']:
-
-        # Skip non-public actions
-        if not ctb.conf.regex.actions[r.action].public:
-            continue
+    r, m = match_regex(comment.body, ctb, public=True)
 
-        # Attempt a match
-        rg = re.compile(r.regex, re.IGNORECASE|re.DOTALL)
-        #lg.debug("eval_comment(): matching '%s' with <%s>", comment.body, r.regex)
-        m = rg.search(body)
+    if m:
+        # Match found
+        lg.debug("eval_comment(): match found")
 
-        if m:
-            # Match found
-            lg.debug("eval_comment(): match found")
-
-            # Extract matched fields into variables
-            u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
-            to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
-            amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
-            keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
-            
-            # Check if subreddit is promos
-            if comment.subreddit == 'promos':
-                return None
-
-            # If no destination mentioned, find parent submission's author
-            if not u_to and not to_addr:
-                # set u_to to author of parent comment
-                u_to = ctb_misc.reddit_get_parent_author(comment, ctb.reddit, ctb)
-                if not u_to:
-                    # couldn't determine u_to, giving up
-                    return None
-
-            # Check if from_user == to_user
-            if u_to and comment.author.name.lower() == u_to.lower():
-                lg.warning("eval_comment(): comment.author.name == u_to, ignoring comment", comment.author.name)
+        # Extract matched fields into variables
+        u_to = m.group(r.rg_to_user)[1:] if r.rg_to_user > 0 else None
+        to_addr = m.group(r.rg_address) if r.rg_address > 0 else None
+        amount = m.group(r.rg_amount) if r.rg_amount > 0 else None
+        keyword = m.group(r.rg_keyword) if r.rg_keyword > 0 else None
+        
+        # Check if subreddit is promos
+        if comment.subreddit == 'promos':
+            return None
+
+        # If no destination mentioned, find parent submission's author
+        if not u_to and not to_addr:
+            # set u_to to author of parent comment
+            u_to = ctb_misc.reddit_get_parent_author(comment, ctb.reddit, ctb)
+            if not u_to:
+                # couldn't determine u_to, giving up
                 return None
 
-            # Return CtbAction instance with given variables
-            lg.debug("eval_comment(): creating action %s: to_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_to, to_addr, amount, r.coin, r.fiat))
-            #lg.debug("< eval_comment() DONE (yes)")
-            return CtbAction(   atype=r.action,
-                                msg=comment,
-                                to_user=u_to,
-                                to_addr=to_addr,
-                                coin=r.coin,
-                                coin_val=amount if not r.fiat else None,
-                                fiat=r.fiat,
-                                fiat_val=amount if r.fiat else None,
-                                keyword=keyword,
-                                subr=comment.subreddit,
-                                ctb=ctb)
+        # Check if from_user == to_user
+        if u_to and comment.author.name.lower() == u_to.lower():
+            lg.warning("eval_comment(): comment.author.name == u_to, ignoring comment", comment.author.name)
+            return None
+
+        # Return CtbAction instance with given variables
+        lg.debug("eval_comment(): creating action %s: to_user=%s, to_addr=%s, amount=%s, coin=%s, fiat=%s" % (r.action, u_to, to_addr, amount, r.coin, r.fiat))
+        #lg.debug("< eval_comment() DONE (yes)")
+        return CtbAction(   atype=r.action,
+                            msg=comment,
+                            to_user=u_to,
+                            to_addr=to_addr,
+                            coin=r.coin,
+                            coin_val=amount if not r.fiat else None,
+                            fiat=r.fiat,
+                            fiat_val=amount if r.fiat else None,
+                            keyword=keyword,
+                            subr=comment.subreddit,
+                            ctb=ctb)
 
     # No match found
     lg.debug("< eval_comment() DONE (no match)")
     return None
 
-def check_action(atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, ctb=None, is_pending=False):
+# Operators accepted in created_utc argument of action_query(), such as '< 1388534400'
+QUERY_OPERATORS = ['<', '<=', '=', '>=', '>']
+
+# Columns get_actions() needs to rebuild a CtbAction
+ACTION_COLUMNS = ['from_user', 'to_user', 'to_addr', 'coin', 'fiat', 'coin_val', 'fiat_val', 'subreddit', 'msg_id', 'msg_link', 'created_utc']
+
+def action_query(columns, atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, is_pending=False, limit=None, table='t_action'):
+    """
+    Return (sql, params) selecting given columns from table with given attributes.
+    created_utc is either a number (exact match) or a string such as '< 1388534400'.
+    """
+
+    sql_terms = []
+    params = []
+
+    if atype:
+        sql_terms.append("type = %s")
+        params.append(atype)
+    if state:
+        sql_terms.append("state = %s")
+        params.append(state)
+    if coin:
+        sql_terms.append("coin = %s")
+        params.append(coin)
+    if msg_id:
+        sql_terms.append("msg_id = %s")
+        params.append(msg_id)
+    if created_utc:
+        op, value = '=', created_utc
+        if isinstance(created_utc, basestring):
+            parts = created_utc.split()
+            if len(parts) == 2:
+                op, value = parts
+            if not op in QUERY_OPERATORS:
+                raise Exception("action_query(): invalid created_utc %s" % created_utc)
+        sql_terms.append("created_utc %s %%s" % op)
+        params.append(int(value))
+    if from_user:
+        sql_terms.append("from_user = %s")
+        params.append(from_user.lower())
+    if to_user:
+        sql_terms.append("to_user = %s")
+        params.append(to_user.lower())
+    if subr:
+        sql_terms.append("subreddit = %s")
+        params.append(subr)
+    if is_pending:
+        sql_terms.append("state <> 'pending'")
+
+    sql = "SELECT %s FROM %s" % (', '.join(columns), table)
+    if sql_terms:
+        sql += " WHERE " + ' AND '.join(sql_terms)
+    if limit:
+        sql += " LIMIT %d" % limit
+
+    return (sql, tuple(params))
+
+def check_action(atype=None, state=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, ctb=None, is_pending=False, table='t_action'):
     """
     Return True if action with given attributes exists in database
     """
     lg.debug("> check_action(%s)", atype)
 
-    # Build SQL query
-    sql = "SELECT * FROM t_action"
-    sql_terms = []
-    if atype or state or coin or msg_id or created_utc or from_user or to_user or subr or is_pending:
-        sql += " WHERE "
-        if atype:
-            sql_terms.append("type = '%s'" % atype)
-        if state:
-            sql_terms.append("state = '%s'" % state)
-        if coin:
-            sql_terms.append("coin = '%s'" % coin)
-        if msg_id:
-            sql_terms.append("msg_id = '%s'" % msg_id)
-        if created_utc:
-            sql_terms.append("created_utc = %s" % created_utc)
-        if from_user:
-            sql_terms.append("from_user = '%s'" % from_user.lower())
-        if to_user:
-            sql_terms.append("to_user = '%s'" % to_user.lower())
-        if subr:
-            sql_terms.append("subreddit = '%s'" % subr)
-        if is_pending:
-            sql_terms.append("state <> 'pending'")
-        sql += ' AND '.join(sql_terms)
+    sql, params = action_query(['1'], atype=atype, state=state, coin=coin, msg_id=msg_id, created_utc=created_utc, from_user=from_user, to_user=to_user, subr=subr, is_pending=is_pending, limit=1, table=table)
 
     try:
-        lg.debug("check_action(): <%s>", sql)
-        mysqlexec = ctb.db.execute(sql)
-        if mysqlexec.rowcount <= 0:
+        lg.debug("check_action(): <%s> %s", sql, params)
+        mysqlrow = ctb.db.execute(sql, params).fetchone()
+        if not mysqlrow:
             lg.debug("< check_action() DONE (no)")
             return False
         else:
             lg.debug("< check_action() DONE (yes)")
             return True
     except Exception as e:
-        lg.error("check_action(): error executing <%s>: %s", sql, e)
+        lg.error("check_action(): error executing <%s> %s: %s", sql, params, e)
         raise
 
     lg.warning("< check_action() DONE (should not get here)")
     return None
 
+def action_exists(msg_id, created_utc=None, ctb=None):
+    """
+    Return True if an action for msg_id exists in database. Answered from
+    ctb.seen when possible; created_utc of the message lets it also answer
+    'no' for messages newer than what it covers.
+    """
+
+    if ctb.seen:
+        seen = ctb.seen.check(msg_id, created_utc)
+        if seen != None:
+            lg.debug("action_exists(%s): %s (cached)", msg_id, seen)
+            return seen
+
+    exists = check_action(msg_id=msg_id, ctb=ctb)
+    if not exists and (not created_utc or created_utc < archive_cutoff(ctb)):
+        # Action may have been archived
+        exists = check_action(msg_id=msg_id, ctb=ctb, table='t_action_archive')
+    if exists and ctb.seen:
+        ctb.seen.add(msg_id, created_utc)
+    return exists
+
 def get_actions(atype=None, state=None, deleted_msg_id=None, deleted_created_utc=None, coin=None, msg_id=None, created_utc=None, from_user=None, to_user=None, subr=None, ctb=None):
     """
     Return an array of CtbAction objects from database with given attributes
     """
     lg.debug("> get_actions(%s)", atype)
 
-    # Build SQL query
-    sql = "SELECT * FROM t_action"
-    sql_terms = []
-    if atype or state or coin or msg_id or created_utc or from_user or to_user or subr:
-        sql += " WHERE "
-        if atype:
-            sql_terms.append("type = '%s'" % atype)
-        if state:
-            sql_terms.append("state = '%s'" % state)
-        if coin:
-            sql_terms.append("coin = '%s'" % coin)
-        if msg_id:
-            sql_terms.append("msg_id = '%s'" % msg_id)
-        if created_utc:
-            sql_terms.append("created_utc %s" % created_utc)
-        if from_user:
-            sql_terms.append("from_user = '%s'" % from_user.lower())
-        if to_user:
-            sql_terms.append("to_user = '%s'" % to_user.lower())
-        if subr:
-            sql_terms.append("subreddit = '%s'" % subr)
-        sql += ' AND '.join(sql_terms)
-
-#throttle ALL THE THINGS!
-#    if created_utc:
-#        sql += ' LIMIT 100'
+    sql, params = action_query(ACTION_COLUMNS, atype=atype, state=state, coin=coin, msg_id=msg_id, created_utc=created_utc, from_user=from_user, to_user=to_user, subr=subr)
 
     while True:
         try:
             r = []
-            lg.debug("get_actions(): <%s>", sql)
-            mysqlexec = ctb.db.execute(sql)
+            lg.debug("get_actions(): <%s> %s", sql, params)
+            rows = ctb.db.execute(sql, params).fetchall()
 
-            if mysqlexec.rowcount <= 0:
+            if not rows:
                 lg.debug("< get_actions() DONE (no)")
                 return r
 
-            for m in mysqlexec:
-                lg.debug("get_actions(): found %s", m['msg_link'])
-
-                # Get PRAW message (msg) and author (msg.author) objects
-                submission = ctb_misc.praw_call(ctb.reddit.get_submission, m['msg_link'])
+            # Reddit comments are fetched only when a reply is needed, all rows at once
+            loader = CtbMsgLoader(ctb=ctb)
 
-                msg = None
-                
-                if not submission:
-                    lg.warning("get_actions(): submission not found for %s . msgid %s", m['msg_link'], m['msg_id'])
+            for m in rows:
+                lg.debug("get_actions(): found %s", m['msg_link'])
 
-                else:
-                    if not len(submission.comments) > 0:
-                        lg.warning("get_actions(): could not fetch msg (deleted?) from msg_link %s", m['msg_link'])
-                        lg.warning("get_actions(): setting deleted_msg_id %s", m['msg_id'])
-                        deleted_msg_id=m['msg_id']
-                        deleted_created_utc=m['created_utc']
-                    else:
-                        msg = submission.comments[0]
-                        if not msg.author:
-                            lg.warning("get_actions(): could not fetch msg.author (deleted?) from msg_link %s", m['msg_link'])
-                            lg.warning("get_actions(): setting msg.author to original tipper %s", m['from_user'])
-                        
+                msg = loader.add(msg_id=m['msg_id'], created_utc=m['created_utc'], permalink=m['msg_link'])
 
                 r.append( CtbAction( atype=atype,
                                      msg=msg,
@@ -1250,8 +1384,299 @@ def get_actions(atype=None, state=None, deleted_msg_id=None, deleted_created_utc
             return r
 
         except Exception as e:
-            lg.error("get_actions(): error executing <%s>: %s", sql, e)
+            lg.error("get_actions(): error executing <%s> %s: %s", sql, params, e)
             raise
 
     lg.warning("< get_actions() DONE (should not get here)")
     return None
+
+def set_actions_state(actions, state, ctb=None, from_state=None):
+    """
+    Set state of given CtbAction objects in database, in a single transaction.
+    If from_state is given, only actions still in from_state are changed.
+    Returns list of actions that were changed
+    """
+    lg.debug("> set_actions_state(%s, %s, %s)", len(actions), state, from_state)
+
+    byid = dict([(a.msg.id if a.msg else a.deleted_msg_id, a) for a in actions])
+    msg_ids = sorted(byid)
+    changed = []
+    try:
+        with ctb.db.begin() as conn:
+            for i in range(0, len(msg_ids), 500):
+                chunk = msg_ids[i:i + 500]
+                where = "msg_id IN (" + ', '.join(['%s'] * len(chunk)) + ")"
+                if from_state:
+                    # Lock and note rows still in from_state, so only those are reported changed
+                    where += " AND state = %s"
+                    chunk = [r['msg_id'] for r in conn.execute("SELECT msg_id FROM t_action WHERE " + where + ctb_db.for_update(conn), tuple(chunk + [from_state]))]
+                    if not chunk:
+                        continue
+                    where = "msg_id IN (" + ', '.join(['%s'] * len(chunk)) + ") AND state = %s"
+                    conn.execute("UPDATE t_action SET state = %s WHERE " + where, tuple([state] + chunk + [from_state]))
+                else:
+                    conn.execute("UPDATE t_action SET state = %s WHERE " + where, tuple([state] + chunk))
+                changed += [byid[m] for m in chunk if m in byid]
+    except Exception as e:
+        lg.error("set_actions_state(%s): error updating %s actions: %s", state, len(msg_ids), e)
+        raise
+
+    if len(changed) < len(msg_ids):
+        lg.warning("set_actions_state(%s): only %s of %s actions updated", state, len(changed), len(msg_ids))
+
+    lg.debug("< set_actions_state() DONE")
+    return changed
+
+# Columns of t_action, in t_action_archive order
+ARCHIVE_COLUMNS = ['type', 'state', 'created_utc', 'from_user', 'to_user', 'to_addr', 'coin_val', 'fiat_val', 'txid', 'coin', 'fiat', 'subreddit', 'msg_id', 'msg_link']
+
+# Actions that don't move coins, archived whatever their state
+ARCHIVE_TYPES = ['info', 'register', 'accept', 'decline', 'history', 'rates']
+
+# Final states of actions that move coins but didn't, archived too
+ARCHIVE_STATES = ['failed', 'declined', 'expired']
+
+def archive_cutoff(ctb=None):
+    """
+    Return created_utc before which actions may have been moved to t_action_archive.
+    Never later than what ctb.seen covers, so msg_ids it can answer for are all in t_action.
+    """
+
+    if not hasattr(ctb.conf.db, 'archive') or not ctb.conf.db.archive.enabled:
+        return 0
+    age = ctb.conf.db.archive.days * 86400
+    if ctb.seen:
+        age = max(age, ctb.seen.hours * 3600 + 86400)
+    return int(time.time() - age)
+
+def archive_actions(ctb=None, batch_size=1000):
+    """
+    Move actions older than archive_cutoff() that didn't move coins from t_action to t_action_archive,
+    batch_size at a time, each batch in its own transaction. Pending and completed
+    givetip, withdraw and redeem actions stay in t_action.
+    Returns number of actions moved.
+    """
+    lg.debug("> archive_actions()")
+
+    cutoff = archive_cutoff(ctb)
+    if not cutoff:
+        return 0
+
+    # One (type, state) at a time, so each batch is found with the primary key or type_state_created_utc index
+    kinds = [(t, None) for t in ARCHIVE_TYPES]
+    kinds += [(t, s) for t in ['givetip', 'withdraw', 'redeem'] for s in ARCHIVE_STATES]
+
+    moved = 0
+    cols = ', '.join(ARCHIVE_COLUMNS)
+    for atype, state in kinds:
+        while True:
+            sql, params = action_query(['msg_id'], atype=atype, state=state, created_utc='< %d' % cutoff, limit=batch_size)
+            msg_ids = [r['msg_id'] for r in ctb.db.execute(sql, params)]
+            if not msg_ids:
+                break
+
+            where = " WHERE msg_id IN (" + ', '.join(['%s'] * len(msg_ids)) + ")"
+            try:
+                with ctb.db.begin() as conn:
+                    conn.execute("INSERT INTO t_action_archive (" + cols + ") SELECT " + cols + " FROM t_action" + where, tuple(msg_ids))
+                    conn.execute("DELETE FROM t_action" + where, tuple(msg_ids))
+            except Exception as e:
+                lg.error("archive_actions(): error archiving %s %s actions: %s", len(msg_ids), atype, e)
+                raise
+            moved += len(msg_ids)
+
+            if len(msg_ids) < batch_size:
+                break
+
+    lg.info("archive_actions(): moved %s actions created before %s to t_action_archive", moved, time.strftime('%Y-%m-%d', time.gmtime(cutoff)))
+    lg.debug("< archive_actions() DONE")
+    return moved
+
+class CtbMsgIdCache(object):
+    """
+    Bounded set of msg_ids known to have an action in t_action, most recently
+    seen last. It also tracks the created_utc after which it holds every saved
+    msg_id, so a newer message missing from it has no action in t_action.
+    """
+
+    size = None
+    hours = None
+    since = None
+
+    def __init__(self, size=100000, hours=72):
+        self.size = int(size)
+        self.hours = hours
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.negatives = 0
+        self.misses = 0
+
+    def warm(self, db):
+        """
+        Load msg_ids of actions created in the last self.hours hours
+        """
+        lg.debug("> CtbMsgIdCache::warm()")
+
+        since = int(time.time() - self.hours * 3600)
+        sql = "SELECT msg_id, created_utc FROM t_action WHERE created_utc > %s ORDER BY created_utc DESC LIMIT %s"
+        rows = db.execute(sql, (since, self.size)).fetchall()
+
+        with self.lock:
+            self.ids.clear()
+            for r in reversed(rows):
+                self.ids[r['msg_id']] = r['created_utc']
+            if len(rows) >= self.size:
+                # Older actions with the same created_utc may not have fit
+                since = max(since, rows[-1]['created_utc'])
+            self.since = since
+
+        lg.debug("< CtbMsgIdCache::warm() DONE (%s msg_ids since %s)", len(rows), since)
+
+    def add(self, msg_id, created_utc=None):
+        """
+        Remember that msg_id has an action in t_action
+        """
+
+        with self.lock:
+            if self.ids.has_key(msg_id):
+                del self.ids[msg_id]
+            self.ids[msg_id] = created_utc
+            while len(self.ids) > self.size:
+                old_id, old_utc = self.ids.popitem(last=False)
+                if self.since != None:
+                    # Messages as old as the evicted one are no longer covered
+                    self.since = max(self.since, old_utc or time.time())
+
+    def check(self, msg_id, created_utc=None):
+        """
+        Return True if msg_id has an action, False if it certainly doesn't, or None if unknown
+        """
+
+        with self.lock:
+            if self.ids.has_key(msg_id):
+                self.hits += 1
+                return True
+            if self.since != None and created_utc and created_utc > self.since:
+                self.negatives += 1
+                return False
+            self.misses += 1
+            return None
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbMsgIdCache: size=%s/%s, since=%s, hits=%s, negatives=%s, misses=%s>"
+        me = me % (len(self.ids), self.size, self.since, self.hits, self.negatives, self.misses)
+        return me
+
+class CtbMsgLoader(object):
+    """
+    Fetches Reddit comments of a group of CtbLazyMsg objects, using one
+    get_info() call per 100 comments when the first of them is needed
+    """
+
+    ctb = None
+
+    def __init__(self, ctb=None):
+        self.ctb = ctb
+        self.pending = []
+
+    def add(self, msg_id=None, created_utc=None, permalink=None):
+        """
+        Return new CtbLazyMsg belonging to this group
+        """
+
+        msg = CtbLazyMsg(msg_id=msg_id, created_utc=created_utc, permalink=permalink, loader=self)
+        if permalink:
+            self.pending.append(msg)
+        else:
+            # Private messages can't be fetched again
+            msg.loaded = True
+        return msg
+
+    def load(self):
+        """
+        Fetch comments of all CtbLazyMsg objects that haven't been fetched yet
+        """
+        lg.debug("> CtbMsgLoader::load(%s)", len(self.pending))
+
+        pending = self.pending
+        self.pending = []
+
+        for i in range(0, len(pending), 100):
+            chunk = pending[i:i + 100]
+            things = ctb_misc.praw_call(self.ctb.reddit.get_info, thing_id=['t1_' + m.id for m in chunk])
+            if not things:
+                things = []
+            elif not type(things) == list:
+                things = [things]
+            found = dict([(t.id, t) for t in things])
+
+            for m in chunk:
+                m.loaded = True
+                t = found.get(m.id)
+                if not t or (not t.author and t.body in ['[deleted]', '[removed]']):
+                    lg.warning("CtbMsgLoader::load(): could not fetch msg (deleted?) from msg_link %s", m.permalink)
+                    continue
+                if not t.author:
+                    lg.warning("CtbMsgLoader::load(): could not fetch msg.author (deleted?) from msg_link %s", m.permalink)
+                m.obj = t
+
+        lg.debug("< CtbMsgLoader::load() DONE")
+
+class CtbLazyMsg(object):
+    """
+    Stand-in for the Reddit comment of an action loaded from database. Has the
+    id, created_utc and permalink stored in t_action; anything else fetches the
+    comment through its CtbMsgLoader.
+    """
+
+    id = None
+    created_utc = None
+    permalink = None
+    author = None       # CtbAction uses from_user instead
+    body = None
+    loaded = False
+    obj = None
+    loader = None
+
+    def __init__(self, msg_id=None, created_utc=None, permalink=None, loader=None):
+        self.id = msg_id
+        self.created_utc = created_utc
+        self.permalink = permalink
+        self.loader = loader
+
+    def get_obj(self):
+        """
+        Return PRAW comment object, or None if it's gone
+        """
+
+        if not self.loaded and self.loader:
+            self.loader.load()
+        return self.obj
+
+    def reply(self, text):
+        """
+        Reply to comment. Return False if comment can't be fetched.
+        """
+
+        obj = self.get_obj()
+        if not obj:
+            return False
+        return obj.reply(text)
+
+    def __getattr__(self, name):
+        obj = self.get_obj()
+        if not obj:
+            raise AttributeError("CtbLazyMsg::%s: comment %s not available" % (name, self.id))
+        return getattr(obj, name)
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbLazyMsg: id=%s, created_utc=%s, permalink=%s, loaded=%s>"
+        me = me % (self.id, self.created_utc, self.permalink, self.loaded)
+        return me
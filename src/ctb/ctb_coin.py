@@ -15,9 +15,8 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import logging, re, time
-from pifkoin.bitcoind import Bitcoind, BitcoindException
-from httplib import CannotSendRequest
+import logging, re, threading, time
+from ctb_rpc import CtbRpc, CtbRpcException
 
 lg = logging.getLogger('cointipbot')
 
@@ -28,6 +27,9 @@ class CtbCoin(object):
 
     conn = None
     conf = None
+    lock = None
+    limiter = None
+    balances = None
 
     def __init__(self, _conf = None):
         """
@@ -40,16 +42,26 @@ class CtbCoin(object):
 
         self.conf = _conf
 
+        # Wallet unlock/lock sequences of different workers must not interleave
+        self.lock = threading.RLock()
+
+        # Throttle calls to daemon, backing off when it's struggling
+        self.limiter = CtbRateLimiter(_conf=self.conf.ratelimit if hasattr(self.conf, 'ratelimit') else None)
+
+        # Cache account balances for balance_ttl seconds
+        self.balances = CtbBalanceCache(ttl=self.conf.balance_ttl if hasattr(self.conf, 'balance_ttl') else 0)
+
         # connect to coin daemon
         try:
             lg.debug("CtbCoin::__init__(): connecting to %s...", self.conf.name)
-            self.conn = Bitcoind(self.conf.config_file, rpcserver=self.conf.config_rpcserver)
-        except BitcoindException as e:
+            self.conn = CtbRpc(self.conf.config_file,
+                               rpcserver=self.conf.config_rpcserver if hasattr(self.conf, 'config_rpcserver') else None,
+                               poolsize=self.conf.rpcpool if hasattr(self.conf, 'rpcpool') else 4)
+        except CtbRpcException as e:
             lg.error("CtbCoin::__init__(): error connecting to %s using %s: %s", self.conf.name, self.conf.config_file, e)
             raise
 
         lg.info("CtbCoin::__init__():: connected to %s", self.conf.name)
-        time.sleep(0.5)
 
         # set transaction fee
         lg.info("Setting tx fee of %f", self.conf.txfee)
@@ -64,15 +76,18 @@ class CtbCoin(object):
 
         user = self.verify_user(_user=_user)
         minconf = self.verify_minconf(_minconf=_minconf)
-        balance = float(0)
+        balance = self.balances.get(user, minconf)
+        if balance != None:
+            return balance
 
         try:
-            balance = self.conn.getbalance(user, minconf)
-        except BitcoindException as e:
+            with self.limiter:
+                balance = self.conn.getbalance(user, minconf)
+        except CtbRpcException as e:
             lg.error("CtbCoin.getbalance(): error getting %s (minconf=%s) balance for %s: %s", self.conf.name, minconf, user, e)
             raise
 
-        time.sleep(0.5)
+        self.balances.put(user, minconf, float(balance))
         return float(balance)
 
     def sendtouser(self, _userfrom = None, _userto = None, _amount = None, _minconf = 1):
@@ -89,15 +104,67 @@ class CtbCoin(object):
         # send request to coin daemon
         try:
             lg.info("CtbCoin::sendtouser(): moving %s %s from %s to %s", amount, self.conf.name, userfrom, userto)
-            result = self.conn.move(userfrom, userto, amount)
-            time.sleep(0.5)
+            with self.limiter:
+                result = self.conn.move(userfrom, userto, amount)
         except Exception as e:
             lg.error("CtbCoin::sendtouser(): error sending %s %s from %s to %s: %s", amount, self.conf.name, userfrom, userto, e)
+            # Move may or may not have happened
+            self.balances.invalidate(userfrom)
+            self.balances.invalidate(userto)
             return False
 
-        time.sleep(0.5)
+        # Moves between accounts count towards balances regardless of minconf
+        self.balances.adjust(userfrom, -amount)
+        self.balances.adjust(userto, amount)
         return True
 
+    def sendtousers(self, _userfrom = None, _amounts = None):
+        """
+        Transfer (move) coins from one user to several users in a single daemon request.
+        _amounts is a dictionary of username -> amount.
+        Returns (dict) username -> True where the move succeeded, False where it
+        failed, or None where the outcome is unknown (daemon unreachable mid-request)
+        """
+        lg.debug("CtbCoin::sendtousers(%s, %s)", _userfrom, _amounts)
+
+        userfrom = self.verify_user(_user=_userfrom)
+        amounts = {}
+        for u in _amounts:
+            amounts[self.verify_user(_user=u)] = self.verify_amount(_amount=_amounts[u])
+        users = sorted(amounts)
+
+        # send request to coin daemon
+        try:
+            lg.info("CtbCoin::sendtousers(): moving %s %s from %s to %s users", sum(amounts.values()), self.conf.name, userfrom, len(users))
+            with self.limiter:
+                results = self.conn.batch([('move', userfrom, u, amounts[u]) for u in users], raise_errors=False)
+        except Exception as e:
+            lg.error("CtbCoin::sendtousers(): error sending %s from %s to %s: %s", self.conf.name, userfrom, users, e)
+            # Moves may or may not have happened
+            self.balances.invalidate(userfrom)
+            for u in users:
+                self.balances.invalidate(u)
+            return dict([(u, None) for u in users])
+
+        r = {}
+        for u, result in zip(users, results):
+            if result == None:
+                lg.error("CtbCoin::sendtousers(): no result for %s %s from %s to %s", amounts[u], self.conf.name, userfrom, u)
+                self.balances.invalidate(userfrom)
+                self.balances.invalidate(u)
+                r[u] = None
+                continue
+            if isinstance(result, CtbRpcException) or not result:
+                lg.error("CtbCoin::sendtousers(): error sending %s %s from %s to %s: %s", amounts[u], self.conf.name, userfrom, u, result)
+                self.balances.invalidate(userfrom)
+                self.balances.invalidate(u)
+                r[u] = False
+                continue
+            self.balances.adjust(userfrom, -amounts[u])
+            self.balances.adjust(u, amounts[u])
+            r[u] = True
+        return r
+
     def sendtoaddr(self, _userfrom = None, _addrto = None, _amount = None):
         """
         Send coins to address
@@ -115,25 +182,28 @@ class CtbCoin(object):
         try:
             lg.info("CtbCoin::sendtoaddr(): sending %s %s from %s to %s", amount, self.conf.name, userfrom, addrto)
 
-            # Unlock wallet, if applicable
-            if hasattr(self.conf, 'walletpassphrase'):
-                lg.debug("CtbCoin::sendtoaddr(): unlocking wallet...")
-                self.conn.walletpassphrase(self.conf.walletpassphrase, 1)
+            with self.lock, self.limiter:
+                # Unlock wallet, if applicable
+                if hasattr(self.conf, 'walletpassphrase'):
+                    lg.debug("CtbCoin::sendtoaddr(): unlocking wallet...")
+                    self.conn.walletpassphrase(self.conf.walletpassphrase, 1)
 
-            # Perform transaction
-            lg.debug("CtbCoin::sendtoaddr(): calling sendfrom()...")
-            txid = self.conn.sendfrom(userfrom, addrto, amount, minconf)
+                # Perform transaction
+                lg.debug("CtbCoin::sendtoaddr(): calling sendfrom()...")
+                txid = self.conn.sendfrom(userfrom, addrto, amount, minconf)
 
-            # Lock wallet, if applicable
-            if hasattr(self.conf, 'walletpassphrase'):
-                lg.debug("CtbCoin::sendtoaddr(): locking wallet...")
-                self.conn.walletlock()
+                # Lock wallet, if applicable
+                if hasattr(self.conf, 'walletpassphrase'):
+                    lg.debug("CtbCoin::sendtoaddr(): locking wallet...")
+                    self.conn.walletlock()
 
         except Exception as e:
             lg.error("CtbCoin::sendtoaddr(): error sending %s %s from %s to %s: %s", amount, self.conf.name, userfrom, addrto, e)
+            self.balances.invalidate(userfrom)
             raise
 
-        time.sleep(0.5)
+        # Network fee isn't known in advance, fetch balance again next time
+        self.balances.invalidate(userfrom)
         return str(txid)
 
     def validateaddr(self, _addr = None):
@@ -144,8 +214,8 @@ class CtbCoin(object):
         lg.debug("CtbCoin::validateaddr(%s)", _addr)
 
         addr = self.verify_addr(_addr=_addr)
-        addr_valid = self.conn.validateaddress(addr)
-        time.sleep(0.5)
+        with self.limiter:
+            addr_valid = self.conn.validateaddress(addr)
 
         if not addr_valid.has_key('isvalid') or not addr_valid['isvalid']:
             lg.debug("CtbCoin::validateaddr(%s): not valid", addr)
@@ -154,56 +224,83 @@ class CtbCoin(object):
             lg.debug("CtbCoin::validateaddr(%s): valid", addr)
             return True
 
+    def getbalances(self, _users = None, _minconf = None):
+        """
+        Get balance of each of _users in a single request to coin daemon
+        Returns (dict) of username => (float) balance
+        """
+        lg.debug("CtbCoin::getbalances(%s, %s)", _users, _minconf)
+
+        users = [self.verify_user(_user=u) for u in _users]
+        minconf = self.verify_minconf(_minconf=_minconf)
+
+        result = {}
+        for u in users:
+            balance = self.balances.get(u, minconf)
+            if balance != None:
+                result[u] = balance
+        missing = [u for u in users if not result.has_key(u)]
+
+        try:
+            with self.limiter:
+                balances = self.conn.batch([('getbalance', u, minconf) for u in missing])
+        except CtbRpcException as e:
+            lg.error("CtbCoin.getbalances(): error getting %s (minconf=%s) balances: %s", self.conf.name, minconf, e)
+            raise
+
+        for u, b in zip(missing, balances):
+            result[u] = float(b)
+            self.balances.put(u, minconf, result[u])
+
+        return result
+
     def getnewaddr(self, _user = None):
         """
         Generate a new address for _user
         Returns (string) address
         """
 
-        user = self.verify_user(_user=_user)
-        addr = ""
+        return self.getnewaddrs(_users=[_user])[self.verify_user(_user=_user)]
+
+    def getnewaddrs(self, _users = None):
+        """
+        Generate a new address for each of _users in a single request to coin daemon
+        Returns (dict) of username => (string) address
+        """
+
+        users = [self.verify_user(_user=u) for u in _users]
         counter = 0
 
+        # Unlock wallet for keypoolrefill and lock it again in the same request
+        calls = [('getnewaddress', u) for u in users]
+        if hasattr(self.conf, 'walletpassphrase'):
+            calls = [('walletpassphrase', self.conf.walletpassphrase, 1)] + calls + [('walletlock',)]
+
         while True:
             try:
-                # Unlock wallet for keypoolrefill
-                if hasattr(self.conf, 'walletpassphrase'):
-                    self.conn.walletpassphrase(self.conf.walletpassphrase, 1)
+                with self.lock, self.limiter:
+                    results = self.conn.batch(calls)
 
-                # Generate new address
-                addr = self.conn.getnewaddress(user)
-
-                # Lock wallet
                 if hasattr(self.conf, 'walletpassphrase'):
-                    self.conn.walletlock()
+                    results = results[1:-1]
 
-                if not addr:
-                    raise Exception("CtbCoin::getnewaddr(%s): empty addr", user)
+                addrs = {}
+                for u, addr in zip(users, results):
+                    if not addr:
+                        raise Exception("CtbCoin::getnewaddrs(%s): empty addr" % u)
+                    addrs[u] = str(addr)
 
-                time.sleep(0.1)
-                return str(addr)
+                return addrs
 
-            except BitcoindException as e:
-                lg.error("CtbCoin::getnewaddr(%s): BitcoindException: %s", user, e)
-                raise
-            except CannotSendRequest as e:
-                if counter < 3:
-                    lg.warning("CtbCoin::getnewaddr(%s): CannotSendRequest, retrying")
+            except CtbRpcException as e:
+                if str(e).find("timed out") > -1 and counter < 3:
+                    lg.warning("CtbCoin::getnewaddrs(%s): timed out, retrying", users)
                     counter += 1
                     time.sleep(10)
                     continue
                 else:
+                    lg.error("CtbCoin::getnewaddrs(%s): CtbRpcException: %s", users, e)
                     raise
-            except Exception as e:
-                if str(e) == "timed out" and counter < 3:
-                    lg.warning("CtbCoin::getnewaddr(%s): timed out, retrying")
-                    counter += 1
-                    time.sleep(10)
-                    continue
-                else:
-                    lg.error("CtbCoin::getnewaddr(%s): Exception: %s", user, e)
-                    raise
-
 
     def verify_user(self, _user = None):
         """
@@ -244,3 +341,190 @@ class CtbCoin(object):
             raise Exception("CtbCoin::verify_minconf(): _minconf wrong type (%s), empty, or negative (%s)", type(_minconf), _minconf)
 
         return _minconf
+
+
+class CtbBalanceCache(object):
+    """
+    Cache of account balances keyed by (user, minconf). Entries are adjusted
+    in-process when coins are moved and fetched again from coin daemon once
+    they are older than ttl seconds. Adjusted entries are kept a while longer
+    (keep_adjusted times ttl), so the next fetch can count whether the balance
+    changed outside of this process.
+    """
+
+    ttl = None
+    keep_adjusted = 10
+
+    def __init__(self, ttl = 0):
+        """
+        Initialize CtbBalanceCache. A ttl of 0 disables caching.
+        """
+
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.entries = {}   # user => {minconf => [balance, time fetched, adjusted]}
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.reconciled = 0
+
+    def get(self, user, minconf):
+        """
+        Return cached balance, or None if it needs to be fetched from coin daemon
+        """
+
+        with self.lock:
+            e = self.entries.get(user, {}).get(minconf)
+            if e and time.time() - e[1] < self.ttl:
+                self.hits += 1
+                return e[0]
+            self.misses += 1
+            return None
+
+    def put(self, user, minconf, balance):
+        """
+        Store balance fetched from coin daemon
+        """
+
+        if not self.ttl > 0.0:
+            return
+
+        with self.lock:
+            e = self.entries.get(user, {}).get(minconf)
+            if e and e[2] and abs(e[0] - balance) > 0.000001:
+                # Balance changed outside of this process (e.g. a deposit) since we last fetched it
+                lg.debug("CtbBalanceCache::put(%s, %s): reconciled %s => %s", user, minconf, e[0], balance)
+                self.reconciled += 1
+            self.entries.setdefault(user, {})[minconf] = [balance, time.time(), False]
+
+    def adjust(self, user, amount):
+        """
+        Add amount to every cached balance of user
+        """
+
+        with self.lock:
+            for e in self.entries.get(user, {}).values():
+                e[0] += amount
+                e[2] = True
+
+    def invalidate(self, user):
+        """
+        Drop every cached balance of user
+        """
+
+        with self.lock:
+            self.entries.pop(user, None)
+
+    def expire(self):
+        """
+        Drop entries older than ttl, or than keep_adjusted * ttl if adjusted
+        """
+
+        with self.lock:
+            now = time.time()
+            for user in self.entries.keys():
+                for minconf in self.entries[user].keys():
+                    e = self.entries[user][minconf]
+                    if now - e[1] >= (self.ttl * self.keep_adjusted if e[2] else self.ttl):
+                        del self.entries[user][minconf]
+                if not self.entries[user]:
+                    del self.entries[user]
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbBalanceCache: ttl=%s, users=%s, hits=%s, misses=%s, reconciled=%s>"
+        me = me % (self.ttl, len(self.entries), self.hits, self.misses, self.reconciled)
+        return me
+
+class CtbRateLimiter(object):
+    """
+    Token bucket limiting the rate of calls to a coin daemon. An extra delay is
+    added when calls fail or get slower than conf.latency, and is reduced again
+    as calls succeed. Use as a context manager around each call.
+    """
+
+    rate = None         # calls per second, None means unlimited
+    burst = None        # number of calls that can be made back-to-back
+    latency = None      # calls slower than this (seconds) trigger a back-off
+    backoff_max = None  # maximum back-off delay (seconds)
+
+    def __init__(self, _conf = None):
+        """
+        Initialize CtbRateLimiter. _conf is the ratelimit section of a coin in conf/coins.yml
+        """
+
+        self.rate = float(_conf.rate) if _conf and hasattr(_conf, 'rate') else None
+        self.burst = float(_conf.burst) if _conf and hasattr(_conf, 'burst') else 1.0
+        self.latency = float(_conf.latency) if _conf and hasattr(_conf, 'latency') else 2.0
+        self.backoff_max = float(_conf.backoff_max) if _conf and hasattr(_conf, 'backoff_max') else 10.0
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.backoff = 0.0
+
+        # Metrics
+        self.calls = 0
+        self.errors = 0
+        self.waited = 0.0
+
+    def __enter__(self):
+        """
+        Wait until a call can be made
+        """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.rate:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                wait = self.backoff - waited
+                if self.rate and self.tokens < 1.0:
+                    wait = max(wait, (1.0 - self.tokens) / self.rate)
+
+                if wait <= 0.0:
+                    if self.rate:
+                        self.tokens -= 1.0
+                    self.calls += 1
+                    self.waited += waited
+                    break
+
+            time.sleep(wait)
+            waited += wait
+
+        if waited > 0.0:
+            lg.debug("CtbRateLimiter::__enter__(): waited %.3fs", waited)
+        self.local.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        """
+        Adjust back-off delay given outcome and duration of call
+        """
+
+        elapsed = time.time() - self.local.started
+        with self.lock:
+            if exc_type or elapsed > self.latency:
+                if exc_type:
+                    self.errors += 1
+                self.backoff = min(self.backoff_max, max(self.backoff * 2.0, 0.1))
+                lg.warning("CtbRateLimiter::__exit__(): %s after %.3fs, backing off %.3fs", "error" if exc_type else "slow call", elapsed, self.backoff)
+            elif self.backoff > 0.0:
+                self.backoff = self.backoff / 2.0 if self.backoff > 0.1 else 0.0
+
+        return False
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbRateLimiter: rate=%s, calls=%s, errors=%s, waited=%.3fs, backoff=%.3fs>"
+        me = me % (self.rate, self.calls, self.errors, self.waited, self.backoff)
+        return me
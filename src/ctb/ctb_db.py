@@ -15,19 +15,341 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, Numeric, UnicodeText
-from sqlalchemy.pool import SingletonThreadPool
+import logging, os, re, time
+from sqlalchemy import create_engine, event, inspect, Table, Column, Integer, String, MetaData, ForeignKey, Numeric, UnicodeText, Enum, Float, Index, TIMESTAMP, text
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.pool import QueuePool
+
+lg = logging.getLogger('cointipbot')
+
+# Unsigned on MySQL, plain INTEGER/FLOAT elsewhere
+UnsignedInt = Integer().with_variant(mysql.INTEGER(unsigned=True), 'mysql')
+UnsignedFloat = Float().with_variant(mysql.FLOAT(unsigned=True), 'mysql')
+
+def action_columns():
+  '''Return new Column objects of t_action, also used by t_action_archive'''
+  return [
+    Column('type', Enum('givetip', 'withdraw', 'info', 'register', 'accept', 'decline', 'history', 'redeem', 'rates', name='action_type'), primary_key=True),
+    Column('state', Enum('completed', 'pending', 'failed', 'declined', 'expired', name='action_state'), nullable=False),
+    Column('created_utc', UnsignedInt, primary_key=True, autoincrement=False),
+    Column('from_user', String(30), nullable=False),
+    Column('to_user', String(30)),
+    Column('to_addr', String(34)),
+    Column('coin_val', UnsignedFloat),
+    Column('fiat_val', UnsignedFloat),
+    Column('txid', String(64)),
+    Column('coin', String(3)),
+    Column('fiat', String(3)),
+    Column('subreddit', String(30)),
+    Column('msg_id', String(10), primary_key=True),
+    Column('msg_link', String(200))]
 
 class CointipBotDatabase:
 
   metadata = MetaData()
 
-  def __init__(self, dsn_url):
-    '''Pass a DSN URL conforming to the SQLAlchemy API'''
+  # Schema, matching altcointip.sql
+  t_action = Table('t_action', metadata,
+    *action_columns() + [
+    Index('msg_id', 'msg_id', unique=True),
+    Index('to_user_state', 'to_user', 'state', 'type'),
+    Index('from_user_to_user_state_coin', 'from_user', 'to_user', 'state', 'coin'),
+    Index('type_state_created_utc', 'type', 'state', 'created_utc'),
+    Index('from_user_created_utc', 'from_user', 'created_utc'),
+    Index('to_user_created_utc', 'to_user', 'created_utc')],
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  # Old actions moved out of t_action by ctb_action.archive_actions()
+  t_action_archive = Table('t_action_archive', metadata,
+    *action_columns() + [
+    Index('archive_msg_id', 'msg_id', unique=True),
+    Index('archive_from_user_created_utc', 'from_user', 'created_utc'),
+    Index('archive_to_user_created_utc', 'to_user', 'created_utc')],
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  t_addrs = Table('t_addrs', metadata,
+    Column('username', String(30), primary_key=True),
+    Column('coin', String(3), primary_key=True),
+    Column('address', String(34), nullable=False),
+    Index('address', 'address', unique=True),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  t_user_totals = Table('t_user_totals', metadata,
+    Column('username', String(30), primary_key=True),
+    Column('direction', Enum('tipped', 'received', name='totals_direction'), primary_key=True),
+    Column('coin', String(3), primary_key=True, server_default=''),
+    Column('fiat', String(3), primary_key=True, server_default=''),
+    Column('total_coin', Float(precision=53), nullable=False, server_default='0'),
+    Column('total_fiat', Float(precision=53), nullable=False, server_default='0'),
+    Column('num', Integer, nullable=False, server_default='0'),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  t_users = Table('t_users', metadata,
+    Column('username', String(30), primary_key=True),
+    Column('joindate', TIMESTAMP, nullable=False, server_default=text('CURRENT_TIMESTAMP')),
+    Column('giftamount', Float, server_default='0'),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  t_values = Table('t_values', metadata,
+    Column('param0', String(64), primary_key=True),
+    Column('value0', Integer, nullable=False, server_default='0'),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  t_wiki_pages = Table('t_wiki_pages', metadata,
+    Column('subreddit', String(30), primary_key=True),
+    Column('page', String(64), primary_key=True),
+    Column('hash', String(40), nullable=False),
+    Column('updated_utc', UnsignedInt, nullable=False),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  # Migrations applied to this database, see migrate()
+  t_schema = Table('t_schema', metadata,
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(64), nullable=False),
+    Column('applied_utc', UnsignedInt, nullable=False),
+    mysql_engine='InnoDB', mysql_charset='utf8')
+
+  # Defaults for pool settings missing from db.yml
+  pool_defaults = {'size': 5, 'max_overflow': 10, 'timeout': 30, 'recycle': 3600, 'pre_ping': True}
+
+  def __init__(self, dsn_url, pool=None):
+    '''Pass a DSN URL conforming to the SQLAlchemy API, and optional dict of pool settings'''
     self.dsn_url = dsn_url
+    self.pool = dict(self.pool_defaults)
+    if pool:
+      self.pool.update(pool)
 
   def connect(self):
-    '''Return a connection object'''
-    engine = create_engine(self.dsn_url, echo_pool=True, poolclass=SingletonThreadPool)
+    '''Return an engine holding a bounded pool of connections, safe to use from several threads.
+    Use engine.begin() to run several statements as one transaction.'''
+    if self.dsn_url.startswith('sqlite'):
+      engine = self.connect_sqlite()
+    else:
+      engine = create_engine(self.dsn_url, poolclass=QueuePool,
+                             pool_size=int(self.pool['size']),
+                             max_overflow=int(self.pool['max_overflow']),
+                             pool_timeout=int(self.pool['timeout']),
+                             pool_recycle=int(self.pool['recycle']),
+                             pool_pre_ping=bool(self.pool['pre_ping']))
     self.metadata.create_all(engine)
     return engine
+
+  def connect_sqlite(self):
+    '''Return an engine for an SQLite database file, in WAL mode so readers don't block the writer.
+    Queries written for MySQL (%s and %(name)s placeholders) are converted to SQLite's ? and :name placeholders.'''
+    path = self.dsn_url.split(':///', 1)[1] if ':///' in self.dsn_url else ''
+    if path and os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+
+    engine = create_engine(self.dsn_url, poolclass=QueuePool,
+                           pool_size=int(self.pool['size']),
+                           max_overflow=int(self.pool['max_overflow']),
+                           pool_timeout=int(self.pool['timeout']),
+                           connect_args={'check_same_thread': False, 'timeout': int(self.pool['timeout'])})
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_conn, conn_record):
+      # Let SQLAlchemy issue BEGIN, so engine.begin() transactions work as on MySQL
+      dbapi_conn.isolation_level = None
+      cursor = dbapi_conn.cursor()
+      cursor.execute("PRAGMA journal_mode=WAL")
+      cursor.execute("PRAGMA synchronous=NORMAL")
+      cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+      conn.execute("BEGIN")
+
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+      statement = re.sub(r'%\((\w+)\)s', r':\1', statement)
+      return statement.replace('%s', '?').replace('%%', '%'), parameters
+
+    return engine
+
+def dsn(conf, test=False):
+  '''Return DSN URL for db config: MySQL server from conf.auth, or SQLite file from conf.sqlite if conf.backend is sqlite'''
+  if hasattr(conf, 'backend') and conf.backend == 'sqlite':
+    path = conf.sqlite.test_path if test else conf.sqlite.path
+    return "sqlite:///%s" % os.path.expanduser(path)
+  return "mysql+mysqldb://%s:%s@%s:%s/%s?charset=utf8" % (conf.auth.user, conf.auth.password, conf.auth.host, conf.auth.port, conf.auth.test_dbname if test else conf.auth.dbname)
+
+def upsert(conn, table, key, values, add=None):
+  '''Insert row into table, or update it if a row with same key exists, on any backend.
+  key and values are dicts of column: value. Columns in add are added to existing value instead of replacing it.
+  key must match a primary key or unique index of table. Returns number of rows affected.
+  Uses a single atomic statement on MySQL and SQLite 3.24+, so concurrent first inserts of a key don't collide.'''
+  add = add or {}
+  cols = list(key) + list(values) + list(add)
+  params = tuple(key.values()) + tuple(values.values()) + tuple(add.values())
+  insert = "INSERT INTO %s (%s) VALUES (%s)" % (table, ', '.join(cols), ', '.join(['%s'] * len(cols)))
+
+  if conn.dialect.name == 'mysql':
+    sets = ["%s = VALUES(%s)" % (c, c) for c in values] + ["%s = %s + VALUES(%s)" % (c, c, c) for c in add]
+    if not sets:
+      sets = ["%s = %s" % (c, c) for c in key]
+    return conn.execute(insert + " ON DUPLICATE KEY UPDATE " + ', '.join(sets), params).rowcount
+
+  if conn.dialect.name == 'sqlite' and conn.dialect.dbapi.sqlite_version_info >= (3, 24, 0):
+    sets = ["%s = excluded.%s" % (c, c) for c in values] + ["%s = %s + excluded.%s" % (c, c, c) for c in add]
+    action = "DO UPDATE SET " + ', '.join(sets) if sets else "DO NOTHING"
+    return conn.execute(insert + " ON CONFLICT (%s) %s" % (', '.join(key), action), params).rowcount
+
+  # Other backends: update, else insert, and update again if a concurrent insert got there first
+  sets = ["%s = %%s" % c for c in values] + ["%s = %s + %%s" % (c, c) for c in add]
+  where = ["%s = %%s" % c for c in key]
+  update = "UPDATE %s SET %s WHERE %s" % (table, ', '.join(sets), ' AND '.join(where))
+  update_params = tuple(values.values()) + tuple(add.values()) + tuple(key.values())
+  if sets:
+    rowcount = conn.execute(update, update_params).rowcount
+    if rowcount > 0:
+      return rowcount
+  try:
+    with conn.begin_nested():
+      return conn.execute(insert, params).rowcount
+  except IntegrityError:
+    if not sets:
+      return 0
+    return conn.execute(update, update_params).rowcount
+
+def for_update(conn):
+  '''Return clause locking selected rows until end of transaction, where backend supports it'''
+  return " FOR UPDATE" if conn.dialect.name == 'mysql' else ""
+
+def has_index(engine, table, name):
+  '''Return True if table has an index called name'''
+  return name in [i['name'] for i in inspect(engine).get_indexes(table)]
+
+def has_column(engine, table, name):
+  '''Return True if table has a column called name'''
+  return name in [c['name'] for c in inspect(engine).get_columns(table)]
+
+# MySQL errors meaning an ALTER can't be done in place without locking the table
+ER_ALTER_OPERATION_NOT_SUPPORTED = [1845, 1846]
+
+def alter_online(engine, table, change):
+  '''Run ALTER TABLE table change on MySQL without blocking writes (ALGORITHM=INPLACE, LOCK=NONE).
+  Falls back to a locking ALTER only if MySQL says the change can't be done in place; other errors are raised.'''
+  try:
+    engine.execute("ALTER TABLE `%s` %s, ALGORITHM=INPLACE, LOCK=NONE" % (table, change))
+  except DBAPIError as e:
+    if not e.orig or not e.orig.args or e.orig.args[0] not in ER_ALTER_OPERATION_NOT_SUPPORTED:
+      raise
+    lg.warning("alter_online(): can't %s online on %s (%s), running it with table locked", change, table, e.orig)
+    engine.execute("ALTER TABLE `%s` %s" % (table, change))
+
+def add_index(engine, table, name, columns, unique=False):
+  '''Add index to table unless it's there already. On MySQL the index is built
+  online with alter_online(), so the bot can keep reading and writing the table.'''
+  if has_index(engine, table, name):
+    lg.debug("add_index(): %s already has index %s", table, name)
+    return False
+
+  lg.info("add_index(): adding index %s (%s) to %s...", name, ', '.join(columns), table)
+  started = time.time()
+  kind = "UNIQUE INDEX" if unique else "INDEX"
+  if engine.dialect.name == 'mysql':
+    cols = ', '.join(["`%s`" % c for c in columns])
+    alter_online(engine, table, "ADD %s `%s` (%s)" % (kind, name, cols))
+  else:
+    engine.execute("CREATE %s IF NOT EXISTS %s ON %s (%s)" % (kind, name, table, ', '.join(columns)))
+
+  lg.info("add_index(): added index %s to %s in %.1f s", name, table, time.time() - started)
+  return True
+
+def add_column(engine, table, name, definition):
+  '''Add column to table unless it's there already, online on MySQL (see alter_online()).
+  definition is the column's SQL type and options, such as "varchar(30) DEFAULT NULL".
+  Fill it afterwards with backfill() rather than a DEFAULT that rewrites every row.'''
+  if has_column(engine, table, name):
+    lg.debug("add_column(): %s already has column %s", table, name)
+    return False
+
+  lg.info("add_column(): adding column %s %s to %s...", name, definition, table)
+  if engine.dialect.name == 'mysql':
+    alter_online(engine, table, "ADD COLUMN `%s` %s" % (name, definition))
+  else:
+    engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, definition))
+  return True
+
+def backfill(engine, sql_keys, func, batch_size=1000):
+  '''Call func(conn, keys) for successive batches of up to batch_size keys returned by sql_keys,
+  each batch in its own transaction, so rows are only locked for the duration of one batch.
+  Returns number of keys processed.'''
+  keys = [r[0] for r in engine.execute(sql_keys)]
+  for i in range(0, len(keys), batch_size):
+    with engine.begin() as conn:
+      func(conn, keys[i:i + batch_size])
+    lg.debug("backfill(): %s of %s done", min(i + batch_size, len(keys)), len(keys))
+  return len(keys)
+
+def migrate_action_indexes(engine):
+  '''Add indexes used by check_action() and get_actions() (altcointip-upgrade-1.sql)'''
+  add_index(engine, 't_action', 'to_user_state', ['to_user', 'state', 'type'])
+  add_index(engine, 't_action', 'from_user_to_user_state_coin', ['from_user', 'to_user', 'state', 'coin'])
+  add_index(engine, 't_action', 'type_state_created_utc', ['type', 'state', 'created_utc'])
+
+def migrate_user_totals(engine):
+  '''Add t_user_totals (altcointip-upgrade-2.sql) and fill it from t_action, a batch of users at a time.
+  Each batch replaces its users' rows in one transaction, so the bot can keep saving tips meanwhile,
+  and an interrupted run is simply run again (it's only recorded in t_schema once complete).'''
+  CointipBotDatabase.t_user_totals.create(engine, checkfirst=True)
+
+  def fill(conn, usernames):
+    where = "IN (" + ', '.join(['%s'] * len(usernames)) + ")"
+    conn.execute("DELETE FROM t_user_totals WHERE username " + where, tuple(usernames))
+    for direction, column in [('tipped', 'from_user'), ('received', 'to_user')]:
+      sql = "INSERT INTO t_user_totals (username, direction, coin, fiat, total_coin, total_fiat, num)"
+      sql += " SELECT " + column + ", '" + direction + "', COALESCE(coin, ''), COALESCE(fiat, ''), COALESCE(SUM(coin_val), 0), COALESCE(SUM(fiat_val), 0), COUNT(*)"
+      sql += " FROM t_action WHERE type = 'givetip' AND state = 'completed' AND " + column + " " + where
+      sql += " GROUP BY " + column + ", coin, fiat"
+      conn.execute(sql, tuple(usernames))
+
+  sql_users = "SELECT from_user FROM t_action WHERE type = 'givetip' AND state = 'completed'"
+  sql_users += " UNION SELECT to_user FROM t_action WHERE type = 'givetip' AND state = 'completed' AND to_user IS NOT NULL ORDER BY 1"
+  users = backfill(engine, sql_users, fill)
+  lg.info("migrate_user_totals(): filled t_user_totals for %s users", users)
+
+def migrate_wiki_pages(engine):
+  '''Add t_wiki_pages (altcointip-upgrade-3.sql)'''
+  CointipBotDatabase.t_wiki_pages.create(engine, checkfirst=True)
+
+def migrate_action_archive(engine):
+  '''Add t_action_archive'''
+  CointipBotDatabase.t_action_archive.create(engine, checkfirst=True)
+
+def migrate_history_indexes(engine):
+  '''Add t_action indexes reading a user's actions newest first, used by ctb_stats.get_history()'''
+  add_index(engine, 't_action', 'from_user_created_utc', ['from_user', 'created_utc'])
+  add_index(engine, 't_action', 'to_user_created_utc', ['to_user', 'created_utc'])
+
+# Schema migrations in order they're applied. Append new ones at the end, never renumber.
+# Each must work on a database that already has the change, as new databases get
+# the current schema from CointipBotDatabase.metadata before migrations run.
+MIGRATIONS = [(1, 'action_indexes', migrate_action_indexes),
+              (2, 'user_totals', migrate_user_totals),
+              (3, 'wiki_pages', migrate_wiki_pages),
+              (4, 'action_archive', migrate_action_archive),
+              (5, 'history_indexes', migrate_history_indexes)]
+
+def applied_migrations(engine):
+  '''Return dict of version: applied_utc of migrations recorded in t_schema'''
+  return dict([(r['version'], r['applied_utc']) for r in engine.execute("SELECT version, applied_utc FROM t_schema")])
+
+def migrate(engine, target=None):
+  '''Apply migrations not yet recorded in t_schema, up to version target (default: all).
+  Returns list of versions applied.'''
+  done = applied_migrations(engine)
+  applied = []
+  for version, name, func in MIGRATIONS:
+    if done.has_key(version) or (target != None and version > target):
+      continue
+    lg.info("migrate(): applying migration %s (%s)...", version, name)
+    started = time.time()
+    func(engine)
+    with engine.begin() as conn:
+      upsert(conn, 't_schema', key={'version': version}, values={'name': name, 'applied_utc': int(time.time())})
+    lg.info("migrate(): applied migration %s (%s) in %.1f s", version, name, time.time() - started)
+    applied.append(version)
+  return applied
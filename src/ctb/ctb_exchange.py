@@ -15,7 +15,7 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import json, logging, urllib2, httplib
+import json, logging, socket, threading, urllib2, httplib
 
 lg = logging.getLogger('cointipbot')
 
@@ -25,6 +25,7 @@ class CtbExchange(object):
     """
 
     conf = None
+    connection = None
 
     def __init__(self, _conf = None):
         """
@@ -37,6 +38,9 @@ class CtbExchange(object):
 
         self.conf = _conf
 
+        # Connection to exchange is kept open between requests
+        self.lock = threading.Lock()
+
         # Convert coinlist and fiatlist values to lowercase
         self.conf.coinlist = map(lambda x:x.lower(), self.conf.coinlist)
         self.conf.fiatlist = map(lambda x:x.lower(), self.conf.fiatlist)
@@ -67,9 +71,11 @@ class CtbExchange(object):
 
         return self.supports(_name=_name1) and self.supports(_name=_name2)
 
-    def get_ticker_value(self, _name1 = None, _name2 = None):
+    def get_ticker_value(self, _name1 = None, _name2 = None, _responses = None):
         """
         Return (float) ticker value for given pair
+            _responses is an optional dict of urlpath => decoded response (or exception raised
+            fetching it), shared between calls so that each url is only fetched once, even if it fails
         """
 
         if _name1 == _name2:
@@ -78,6 +84,9 @@ class CtbExchange(object):
         if not self.supports_pair(_name1=_name1, _name2=_name2):
             raise Exception("CtbExchange::get_ticker_value(%s, %s, %s): pair not supported" % (self.conf.domain, _name1, _name2))
 
+        if _responses == None:
+            _responses = {}
+
         results = []
         for myurlpath in self.conf.urlpaths:
             for myjsonpath in self.conf.jsonpaths:
@@ -89,14 +98,14 @@ class CtbExchange(object):
 
                 try:
                     lg.debug("CtbExchange::get_ticker_value(%s, %s, %s): calling %s to get %s...", self.conf.domain, _name1, _name2, myurlpath, myjsonpath)
-                    if self.conf.https:
-                        connection = httplib.HTTPSConnection(self.conf.domain)
-                        connection.request("GET", myurlpath, {}, {})
-                    else:
-                        connection = httplib.HTTPConnection(self.conf.domain)
-                        connection.request("GET", myurlpath)
-                    response = json.loads(connection.getresponse().read())
-                    result = xpath_get(response, myjsonpath)
+                    if not _responses.has_key(myurlpath):
+                        try:
+                            _responses[myurlpath] = json.loads(self.fetch(myurlpath))
+                        except Exception as e:
+                            _responses[myurlpath] = e
+                    if isinstance(_responses[myurlpath], Exception):
+                        raise _responses[myurlpath]
+                    result = xpath_get(_responses[myurlpath], myjsonpath)
                     lg.debug("CtbExchange::get_ticker_value(%s, %s, %s): result: %.6f", self.conf.domain, _name1, _name2, float(result))
                     results.append( float(result) )
 
@@ -113,6 +122,53 @@ class CtbExchange(object):
         # Return average of all responses
         return ( sum(results) / float(len(results)) )
 
+    def get_ticker_values(self, _pairs = None):
+        """
+        Return dict of (name1, name2) => (float) ticker value, or None if it couldn't be
+        determined, for each supported pair in _pairs. Each url is fetched once.
+        """
+
+        responses = {}
+        values = {}
+        for p in _pairs:
+            if self.supports_pair(_name1=p[0], _name2=p[1]):
+                values[p] = self.get_ticker_value(_name1=p[0], _name2=p[1], _responses=responses)
+        return values
+
+    def fetch(self, _urlpath = None):
+        """
+        GET _urlpath over a keep-alive connection to exchange and return response body.
+        A connection dropped by exchange is re-opened and the request retried once.
+        """
+
+        with self.lock:
+            for attempt in [1, 2]:
+                reused = bool(self.connection)
+                if not reused:
+                    timeout = self.conf.timeout if hasattr(self.conf, 'timeout') else 10
+                    if self.conf.https:
+                        self.connection = httplib.HTTPSConnection(self.conf.domain, timeout=timeout)
+                    else:
+                        self.connection = httplib.HTTPConnection(self.conf.domain, timeout=timeout)
+
+                try:
+                    self.connection.request("GET", _urlpath, None, {'Connection': 'keep-alive'})
+                    response = self.connection.getresponse()
+                    body = response.read()
+                except (httplib.HTTPException, socket.error):
+                    self.connection.close()
+                    self.connection = None
+                    if reused and attempt == 1:
+                        continue
+                    raise
+
+                if response.getheader('connection', '').lower() == 'close':
+                    self.connection.close()
+                    self.connection = None
+                if response.status != 200:
+                    raise Exception("HTTP %s from %s%s" % (response.status, self.conf.domain, _urlpath))
+                return body
+
 
 def xpath_get(mydict, path):
     elem = mydict
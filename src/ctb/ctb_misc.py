@@ -15,7 +15,7 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import ctb_user
+import ctb_db, ctb_user
 
 import logging, time
 
@@ -121,43 +121,44 @@ def set_value(conn, param0=None, value0=None):
 
     if param0 == None or value0 == None:
         raise Exception("set_value(): param0 == None or value0 == None")
-    sql = "REPLACE INTO t_values (param0, value0) VALUES (%s, %s)"
 
     try:
 
-        mysqlexec = conn.execute(sql, (param0, value0))
-        if mysqlexec.rowcount <= 0:
-            lg.error("set_value(): query <%s> didn't affect any rows", sql % (param0, value0))
+        with conn.begin() as tconn:
+            rowcount = ctb_db.upsert(tconn, 't_values', key={'param0': param0}, values={'value0': value0})
+        if rowcount <= 0:
+            lg.error("set_value(): setting %s = %s didn't affect any rows", param0, value0)
             return False
 
     except Exception, e:
-        lg.error("set_value: error executing query <%s>: %s", sql % (param0, value0), e)
+        lg.error("set_value: error setting %s = %s: %s", param0, value0, e)
         raise
 
     lg.debug("< set_value() DONE")
     return True
 
-def add_coin(coin, db, coins):
+def add_coin(coin, db, coins, batch_size=100):
     """
-    Add new coin address to each user
+    Add new coin address to each user, generating batch_size addresses per request to coin daemon
     """
     lg.debug("> add_coin(%s)", coin)
 
     sql_select = "SELECT username FROM t_users WHERE username NOT IN (SELECT username FROM t_addrs WHERE coin = %s) ORDER BY username"
-    sql_insert = "REPLACE INTO t_addrs (username, coin, address) VALUES (%s, %s, %s)"
 
     try:
 
         mysqlsel = db.execute(sql_select, (coin))
-        for m in mysqlsel:
-            # Generate new coin address for user
-            new_addr = coins[coin].getnewaddr(_user=m['username'])
-            lg.info("add_coin(): got new address %s for %s", new_addr, m['username'])
-            # Add new coin address to MySQL
-            mysqlins = db.execute(sql_insert, (m['username'].lower(), coin, new_addr))
-            if mysqlins.rowcount <= 0:
-                raise Exception("add_coin(%s): rowcount <= 0 when executing <%s>", coin, sql_insert % (m['username'].lower(), coin, new_addr))
-            time.sleep(1)
+        usernames = [m['username'].lower() for m in mysqlsel]
+        for i in range(0, len(usernames), batch_size):
+            # Generate new coin addresses for a batch of users
+            new_addrs = coins[coin].getnewaddrs(_users=usernames[i:i+batch_size])
+            for username in usernames[i:i+batch_size]:
+                new_addr = new_addrs[username]
+                lg.info("add_coin(): got new address %s for %s", new_addr, username)
+                # Add new coin address to database
+                with db.begin() as conn:
+                    if ctb_db.upsert(conn, 't_addrs', key={'username': username, 'coin': coin}, values={'address': new_addr}) <= 0:
+                        raise Exception("add_coin(%s): rowcount <= 0 when adding address %s of %s" % (coin, new_addr, username))
 
     except Exception, e:
         lg.error("add_coin(%s): error: %s", coin, e)
@@ -0,0 +1,209 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import base64, errno, httplib, json, logging, os, socket, threading
+from decimal import Decimal
+
+lg = logging.getLogger('cointipbot')
+
+# Calls that move coins, never sent twice even if connection fails before an answer arrives
+NO_RETRY_METHODS = ['move', 'sendfrom', 'sendtoaddress', 'sendmany']
+
+class CtbRpcException(Exception):
+    """
+    Error returned by coin daemon, or failure to reach it
+    """
+
+    code = None
+
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        self.code = code
+
+class CtbRpc(object):
+    """
+    JSON-RPC client for a coin daemon. Keeps a pool of keep-alive HTTP
+    connections that can be used by several threads at once, and supports
+    sending several calls in a single request with batch().
+    """
+
+    host = None
+    port = None
+    auth = None
+    poolsize = None
+    timeout = None
+
+    def __init__(self, config_file=None, rpcserver=None, poolsize=4, timeout=30):
+        """
+        Initialize CtbRpc using rpcuser, rpcpassword and rpcport from coin daemon's config_file
+        """
+
+        conf = {}
+        try:
+            for line in open(os.path.expanduser(config_file)):
+                line = line.split('#')[0].strip()
+                if line.find('=') > -1:
+                    k, v = line.split('=', 1)
+                    conf[k.strip()] = v.strip()
+        except IOError as e:
+            raise CtbRpcException("CtbRpc::__init__(): can't read %s: %s" % (config_file, e))
+
+        if not conf.has_key('rpcuser') or not conf.has_key('rpcpassword'):
+            raise CtbRpcException("CtbRpc::__init__(): rpcuser or rpcpassword missing from %s" % config_file)
+
+        self.host = rpcserver or conf.get('rpcconnect', '127.0.0.1')
+        self.port = int(conf.get('rpcport', 8332))
+        self.auth = 'Basic ' + base64.b64encode('%s:%s' % (conf['rpcuser'], conf['rpcpassword']))
+        self.poolsize = int(poolsize)
+        self.timeout = timeout
+
+        self.idle = []
+        self.idle_lock = threading.Lock()
+        self.slots = threading.Semaphore(self.poolsize)
+        self.counter = 0
+
+        lg.debug("CtbRpc::__init__(): %s:%s, %s connections", self.host, self.port, self.poolsize)
+
+    def __getattr__(self, method):
+        """
+        Return a function calling given RPC method, so that self.getbalance(user, minconf) works
+        """
+
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+    def call(self, method, *args):
+        """
+        Call a single RPC method and return its result
+        """
+
+        return self.batch([(method,) + args])[0]
+
+    def batch(self, calls, raise_errors=True):
+        """
+        Send a list of (method, arg1, arg2, ...) tuples in a single request.
+        Returns a list of results in the same order. Raises CtbRpcException
+        if any of the calls failed, unless raise_errors is False, in which
+        case the CtbRpcException takes the place of that call's result.
+        """
+
+        if not calls:
+            return []
+
+        with self.idle_lock:
+            first = self.counter
+            self.counter += len(calls)
+
+        payload = []
+        for i, c in enumerate(calls):
+            payload.append({'version': '1.1', 'method': c[0], 'params': list(c[1:]), 'id': first + i})
+        if len(payload) == 1:
+            payload = payload[0]
+
+        retry = not any([c[0] in NO_RETRY_METHODS for c in calls])
+        response = self.request(json.dumps(payload), retry=retry)
+        if not type(response) == list:
+            response = [response]
+
+        results = {}
+        for r in response:
+            if r.get('error'):
+                error = r['error']
+                if type(error) == dict:
+                    e = CtbRpcException(error.get('message'), code=error.get('code'))
+                else:
+                    e = CtbRpcException(str(error))
+                if raise_errors:
+                    raise e
+                results[r.get('id')] = e
+                continue
+            results[r.get('id')] = r.get('result')
+
+        return [results.get(first + i) for i in range(len(calls))]
+
+    def request(self, body, retry=True):
+        """
+        POST body over a pooled connection and return decoded response.
+        A reused connection that turns out to have gone stale while idle is
+        replaced and the request sent again, but only if the daemon can't have
+        received it (sending failed), or, when retry is True, if the connection
+        was closed before any response byte arrived. Timeouts are never retried.
+        """
+
+        self.slots.acquire()
+        try:
+            for attempt in [1, 2]:
+                conn, reused = self.get_conn()
+                try:
+                    conn.request('POST', '/', body, {'Authorization': self.auth, 'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    if reused and attempt == 1 and not isinstance(e, socket.timeout):
+                        lg.debug("CtbRpc::request(): stale connection to %s:%s (%s), retrying", self.host, self.port, e)
+                        continue
+                    raise CtbRpcException("CtbRpc::request(): error talking to %s:%s: %s" % (self.host, self.port, e))
+
+                response = None
+                try:
+                    response = conn.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error) as e:
+                    conn.close()
+                    # Connection closed by daemon before any response: request was most likely dropped unread
+                    closed = response == None and (isinstance(e, httplib.BadStatusLine) or (type(e) == socket.error and e.errno == errno.ECONNRESET))
+                    if reused and attempt == 1 and retry and closed:
+                        lg.debug("CtbRpc::request(): stale connection to %s:%s (%s), retrying", self.host, self.port, e)
+                        continue
+                    raise CtbRpcException("CtbRpc::request(): error talking to %s:%s: %s" % (self.host, self.port, e))
+
+                if response.status in [401, 403]:
+                    conn.close()
+                    raise CtbRpcException("CtbRpc::request(): %s:%s authorization failed" % (self.host, self.port), code=response.status)
+
+                if response.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                else:
+                    self.put_conn(conn)
+
+                try:
+                    return json.loads(data, parse_float=Decimal)
+                except ValueError as e:
+                    raise CtbRpcException("CtbRpc::request(): invalid response from %s:%s (HTTP %s): %s" % (self.host, self.port, response.status, e), code=response.status)
+        finally:
+            self.slots.release()
+
+    def get_conn(self):
+        """
+        Return (connection, reused) using an idle connection if there is one
+        """
+
+        with self.idle_lock:
+            if self.idle:
+                return (self.idle.pop(), True)
+        return (httplib.HTTPConnection(self.host, self.port, timeout=self.timeout), False)
+
+    def put_conn(self, conn):
+        """
+        Return connection to idle pool
+        """
+
+        with self.idle_lock:
+            if len(self.idle) < self.poolsize:
+                self.idle.append(conn)
+                return
+        conn.close()
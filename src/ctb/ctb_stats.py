@@ -18,17 +18,21 @@
     along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import logging, re, time
-import ctb_misc
+import hashlib, logging, re, threading, time
+import ctb_db, ctb_misc
 
 lg = logging.getLogger('cointipbot')
 
+# Number of wiki pages written, skipped as unchanged and failed by edit_wiki_page()
+wiki_counts = {'written': 0, 'skipped': 0, 'failed': 0}
+wiki_counts_lock = threading.Lock()
+
 def update_stats(ctb=None):
     """
     Update stats wiki page
     """
 
-    stats = ""
+    stats = []
 
     if not ctb.conf.reddit.stats.enabled:
         return None
@@ -36,37 +40,32 @@ def update_stats(ctb=None):
     for s in sorted(vars(ctb.conf.db.sql.globalstats)):
         lg.debug("update_stats(): getting stats for '%s'" % s)
         sql = ctb.conf.db.sql.globalstats[s].query
-        stats += "\n\n### %s\n\n" % ctb.conf.db.sql.globalstats[s].name
-        stats += "%s\n\n" % ctb.conf.db.sql.globalstats[s].desc
+        stats.append("\n\n### %s\n\n" % ctb.conf.db.sql.globalstats[s].name)
+        stats.append("%s\n\n" % ctb.conf.db.sql.globalstats[s].desc)
 
         mysqlexec = ctb.db.execute(sql)
-        if mysqlexec.rowcount <= 0:
+        rows = mysqlexec.fetchall()
+        if not rows:
             lg.warning("update_stats(): query <%s> returned nothing" % ctb.conf.db.sql.globalstats[s].query)
             continue
 
         if ctb.conf.db.sql.globalstats[s].type == "line":
-            m = mysqlexec.fetchone()
+            m = rows[0]
             k = mysqlexec.keys()[0]
             value = format_value(m, k, '', ctb)
-            stats += "%s = **%s**\n" % (k, value)
+            stats.append("%s = **%s**\n" % (k, value))
 
         elif ctb.conf.db.sql.globalstats[s].type == "table":
-            stats += ("|".join(mysqlexec.keys())) + "\n"
-            stats += ("|".join([":---"] * len(mysqlexec.keys()))) + "\n"
-            for m in mysqlexec:
-                values = []
-                for k in mysqlexec.keys():
-                    values.append(format_value(m, k, '', ctb))
-                stats += ("|".join(values)) + "\n"
+            render_table(stats, rows, mysqlexec.keys(), '', ctb)
 
         else:
             lg.error("update_stats(): don't know what to do with type '%s'" % ctb.conf.db.sql.globalstats[s].type)
             return False
 
-        stats += "\n"
+        stats.append("\n")
 
     lg.debug("update_stats(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page))
-    return ctb_misc.praw_call(ctb.reddit.edit_wiki_page, ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page, stats, "Update by ALTcointip bot")
+    return edit_wiki_page(ctb=ctb, page=ctb.conf.reddit.stats.page, content=''.join(stats))
 
 def update_tips(ctb=None):
     """
@@ -77,22 +76,21 @@ def update_tips(ctb=None):
         return None
 
     # Start building stats page
-    tip_list = "### All Completed Tips\n\n"
+    tip_list = ["### All Completed Tips\n\n"]
 
-    q = ctb.db.execute(ctb.conf.db.sql.tips.sql_set)
     tips = ctb.db.execute(ctb.conf.db.sql.tips.sql_list, (ctb.conf.db.sql.tips.limit))
-    tip_list += ("|".join(tips.keys())) + "\n"
-    tip_list += ("|".join([":---"] * len(tips.keys()))) + "\n"
+    keys = tips.keys()
+
+    # Number tips in order listed
+    if not 'num' in keys:
+        keys = ['num'] + keys
+        tips = (dict(t.items(), num=i + 1) for i, t in enumerate(tips))
 
     # Build tips table
-    for t in tips:
-        values = []
-        for k in tips.keys():
-            values.append(format_value(t, k, '', ctb))
-        tip_list += ("|".join(values)) + "\n"
+    render_table(tip_list, tips, keys, '', ctb)
 
     lg.debug("update_tips(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page_tips))
-    ctb_misc.praw_call(ctb.reddit.edit_wiki_page, ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page_tips, tip_list, "Update by ALTcointip bot")
+    edit_wiki_page(ctb=ctb, page=ctb.conf.reddit.stats.page_tips, content=''.join(tip_list))
 
     return True
 
@@ -105,99 +103,309 @@ def update_all_user_stats(ctb=None):
         lg.error('update_all_user_stats(): stats are not enabled in config.yml')
         return None
 
+    # Get totals of all users in one query
+    totals = {}
+    for m in ctb.db.execute(ctb.conf.db.sql.userstats.totals_all):
+        add_totals(totals.setdefault(m['username'].lower(), new_totals()), m)
+
     users = ctb.db.execute(ctb.conf.db.sql.userstats.users)
     for u in users:
-        update_user_stats(ctb=ctb, username=u['username'])
+        update_user_stats(ctb=ctb, username=u['username'], totals=totals.get(u['username'].lower(), new_totals()))
 
-def update_user_stats(ctb=None, username=None):
+def history_query(columns, username, types, limit, cursor=None):
     """
-    Update individual user stats for given username
+    Return (sql, params) selecting columns of up to limit actions of given types
+    from or to username, newest first, older than cursor if given.
+    Each of t_action and t_action_archive is read from its from_user and
+    to_user indexes, so only about limit rows are read from each.
     """
 
-    if not ctb.conf.reddit.stats.enabled:
+    branches = []
+    params = []
+    for table in ['t_action', 't_action_archive']:
+        for column in ['from_user', 'to_user']:
+            sql = "SELECT " + ', '.join(columns) + " FROM " + table + " WHERE " + column + " = %s"
+            sql += " AND type IN (" + ', '.join(['%s'] * len(types)) + ")"
+            params += [username.lower()] + list(types)
+            if cursor:
+                sql += " AND (created_utc < %s OR (created_utc = %s AND msg_id < %s))"
+                params += [cursor[0], cursor[0], cursor[1]]
+            sql += " ORDER BY created_utc DESC, msg_id DESC LIMIT %d" % limit
+            branches.append("SELECT * FROM (" + sql + ") AS h%d" % len(branches))
+
+    sql = " UNION ALL ".join(branches) + " ORDER BY created_utc DESC, msg_id DESC"
+    return (sql, tuple(params))
+
+def get_history(ctb=None, username=None, columns=None, types=None, limit=None, cursor=None):
+    """
+    Return (rows, cursor) with a page of up to limit actions of given types from or to username,
+    newest first, starting after cursor (as returned by a previous call) if given.
+    Returned cursor is None if there are no older actions.
+    """
+    lg.debug("> get_history(%s, %s)", username, cursor)
+
+    cols = list(columns)
+    for c in ['created_utc', 'msg_id']:
+        if not c in cols:
+            cols.append(c)
+
+    sql, params = history_query(cols, username, types, limit + 1, cursor=parse_cursor(cursor))
+    rows = []
+    seen = set()
+    for m in ctb.db.execute(sql, params):
+        # Tips to self are found both as from_user and to_user
+        if m['msg_id'] in seen:
+            continue
+        seen.add(m['msg_id'])
+        rows.append(m)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = format_cursor(rows[-1])
+
+    lg.debug("< get_history(%s) DONE (%s rows, next %s)", username, len(rows), next_cursor)
+    return (rows, next_cursor)
+
+def format_cursor(m):
+    """
+    Return cursor pointing after row m of get_history()
+    """
+
+    return "%d_%s" % (m['created_utc'], m['msg_id'])
+
+def parse_cursor(cursor):
+    """
+    Return (created_utc, msg_id) of cursor, or None if it's not a valid cursor
+    """
+
+    if not cursor:
+        return None
+    m = re.match(r'^(\d+)_([a-z0-9]+)$', cursor.strip().lower())
+    if not m:
+        lg.warning("parse_cursor(): invalid cursor %s", cursor)
+        return None
+    return (int(m.group(1)), m.group(2))
+
+def history_url(ctb=None, cursor=None):
+    """
+    Return URL of message asking bot for history older than cursor
+    """
+
+    return "http://www.reddit.com/message/compose?to=%s&subject=history&message=%%2Bhistory%%20%s" % (ctb.conf.reddit.auth.user, cursor)
+
+def new_totals():
+    """
+    Return empty totals dictionary, as filled by add_totals()
+    """
+
+    return {'tipped': {'coin': {}, 'fiat': {}, 'num': 0}, 'received': {'coin': {}, 'fiat': {}, 'num': 0}}
+
+def add_totals(totals, m):
+    """
+    Add row m of userstats.totals or userstats.totals_all query to totals
+    """
+
+    t = totals[m['direction']]
+    t['num'] += int(m['num'])
+    if m['coin'] and m['total_coin'] != None:
+        t['coin'][m['coin']] = t['coin'].get(m['coin'], 0.0) + m['total_coin']
+    if m['fiat'] and m['total_fiat'] != None:
+        t['fiat'][m['fiat']] = t['fiat'].get(m['fiat'], 0.0) + m['total_fiat']
+
+def get_user_totals(ctb=None, username=None):
+    """
+    Return totals tipped and received by username, per coin and per fiat
+    """
+
+    totals = new_totals()
+    for m in ctb.db.execute(ctb.conf.db.sql.userstats.totals, (username.lower())):
+        add_totals(totals, m)
+    return totals
+
+def add_user_totals(conn, from_user=None, to_user=None, coin=None, fiat=None, coin_val=None, fiat_val=None, sign=1):
+    """
+    Add a completed tip to t_user_totals of from_user and to_user, or take it away if sign is -1.
+    conn is the connection of the transaction saving the tip.
+    """
+
+    for username, direction in [(from_user, 'tipped'), (to_user, 'received')]:
+        if not username:
+            continue
+        ctb_db.upsert(conn, 't_user_totals',
+                      key={'username': username.lower(), 'direction': direction, 'coin': coin or '', 'fiat': fiat or ''},
+                      values={},
+                      add={'total_coin': sign * (coin_val or 0.0), 'total_fiat': sign * (fiat_val or 0.0), 'num': sign})
+
+def rebuild_user_totals(ctb=None):
+    """
+    Recompute t_user_totals from t_action
+    """
+    lg.debug("> rebuild_user_totals()")
+
+    try:
+        with ctb.db.begin() as conn:
+            conn.execute("DELETE FROM t_user_totals")
+            mysqlexec = conn.execute("INSERT INTO t_user_totals (username, direction, coin, fiat, total_coin, total_fiat, num) " + ctb.conf.db.sql.userstats.totals_source)
+    except Exception as e:
+        lg.error("rebuild_user_totals(): error rebuilding t_user_totals: %s", e)
+        raise
+
+    lg.debug("< rebuild_user_totals() DONE (%s rows)", mysqlexec.rowcount)
+    return mysqlexec.rowcount
+
+def verify_user_totals(ctb=None):
+    """
+    Compare t_user_totals with totals computed from t_action.
+    Return list of (username, direction, coin, fiat, expected, found) tuples that differ.
+    """
+    lg.debug("> verify_user_totals()")
+
+    def key(m):
+        return (m['username'].lower(), m['direction'], m['coin'], m['fiat'])
+
+    def values(m):
+        return (float(m['total_coin']), float(m['total_fiat']), int(m['num']))
+
+    def differs(a, b):
+        # Relative tolerance, as sums of large amounts can differ in the last digits depending on order added
+        return abs(a - b) > max(0.000001, 1e-9 * max(abs(a), abs(b)))
+
+    expected = dict([(key(m), values(m)) for m in ctb.db.execute(ctb.conf.db.sql.userstats.totals_source)])
+    found = dict([(key(m), values(m)) for m in ctb.db.execute(ctb.conf.db.sql.userstats.totals_all)])
+
+    r = []
+    for k in sorted(set(expected.keys()) | set(found.keys())):
+        e = expected.get(k, (0.0, 0.0, 0))
+        f = found.get(k, (0.0, 0.0, 0))
+        if e[2] != f[2] or differs(e[0], f[0]) or differs(e[1], f[1]):
+            r.append(k + (e, f))
+
+    lg.debug("< verify_user_totals() DONE (%s differences)", len(r))
+    return r
+
+def content_hash(content):
+    """
+    Return hash of content published to Reddit
+    """
+
+    return hashlib.sha1(content.encode('utf-8') if type(content) == unicode else content).hexdigest()
+
+def is_published(ctb=None, page=None, digest=None):
+    """
+    Return True if content with given hash was last published to page of stats subreddit.
+    page is a wiki page name, or 'flair:<username>' for a user's flair.
+    """
+
+    mysqlrow = ctb.db.execute("SELECT hash FROM t_wiki_pages WHERE subreddit = %s AND page = %s", (ctb.conf.reddit.stats.subreddit, page)).fetchone()
+    return bool(mysqlrow) and mysqlrow['hash'] == digest
+
+def set_published(ctb=None, page=None, digest=None):
+    """
+    Record hash of content just published to page of stats subreddit
+    """
+
+    with ctb.db.begin() as conn:
+        ctb_db.upsert(conn, 't_wiki_pages', key={'subreddit': ctb.conf.reddit.stats.subreddit, 'page': page}, values={'hash': digest, 'updated_utc': int(time.time())})
+
+def edit_wiki_page(ctb=None, page=None, content=None):
+    """
+    Publish content to wiki page of stats subreddit, unless it's identical to what was last published.
+    Returns result of Reddit call, or None if page was skipped.
+    """
+
+    subreddit = ctb.conf.reddit.stats.subreddit
+    digest = content_hash(content)
+
+    if is_published(ctb=ctb, page=page, digest=digest):
+        lg.debug("edit_wiki_page(): subreddit '%s', page '%s' unchanged, skipping", subreddit, page)
+        with wiki_counts_lock:
+            wiki_counts['skipped'] += 1
         return None
 
-    # List of coins
-    coins_q = ctb.db.execute(ctb.conf.db.sql.userstats.coins)
-    coins = []
-    for c in coins_q:
-        coins.append(c['coin'])
+    lg.debug("edit_wiki_page(): updating subreddit '%s', page '%s'", subreddit, page)
+    res = ctb_misc.praw_call(ctb.reddit.edit_wiki_page, subreddit, page, content, "Update by ALTcointip bot")
+    if res == False:
+        with wiki_counts_lock:
+            wiki_counts['failed'] += 1
+        return res
+
+    set_published(ctb=ctb, page=page, digest=digest)
+    with wiki_counts_lock:
+        wiki_counts['written'] += 1
+    return res
+
+def queue_user_stats(ctb=None, username=None):
+    """
+    Have stats of given username updated by ctb.user_stats flusher, or right away if it isn't running
+    """
+
+    if ctb.user_stats:
+        ctb.user_stats.mark(username)
+    else:
+        update_user_stats(ctb=ctb, username=username)
+
+def update_user_stats(ctb=None, username=None, totals=None):
+    """
+    Update individual user stats for given username.
+    totals is result of get_user_totals(), queried if not given.
+    """
 
-    # List of fiat
-    fiat_q = ctb.db.execute(ctb.conf.db.sql.userstats.fiat)
-    fiat = []
-    for f in fiat_q:
-        fiat.append(f['fiat'])
+    if not ctb.conf.reddit.stats.enabled:
+        return None
+
+    # Totals tipped and received, per coin and per fiat
+    if totals == None:
+        totals = get_user_totals(ctb=ctb, username=username)
 
     # Start building stats page
-    user_stats = "### Tipping Summary for /u/%s\n\n" % username
+    user_stats = ["### Tipping Summary for /u/%s\n\n" % username]
     page = ctb.conf.reddit.stats.page + '_' + username
 
     # Total Tipped
-    user_stats += "#### Total Tipped (Fiat)\n\n"
-    user_stats += "fiat|total\n:---|---:\n"
+    user_stats.append("#### Total Tipped (Fiat)\n\n")
+    user_stats.append("fiat|total\n:---|---:\n")
     total_tipped = []
-    for f in fiat:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_tipped_fiat, (username, f))
-        total_tipped_fiat = mysqlexec.fetchone()
-        if total_tipped_fiat['total_fiat'] != None:
-            user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total_tipped_fiat['total_fiat'])
-            total_tipped.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total_tipped_fiat['total_fiat']))
-    user_stats += "\n"
-
-    user_stats += "#### Total Tipped (Coins)\n\n"
-    user_stats += "coin|total\n:---|---:\n"
-    for c in coins:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_tipped_coin, (username, c))
-        total_tipped_coin = mysqlexec.fetchone()
-        if total_tipped_coin['total_coin'] != None:
-            user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total_tipped_coin['total_coin'])
-    user_stats += "\n"
+    for f in sorted(totals['tipped']['fiat']):
+        user_stats.append("**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, totals['tipped']['fiat'][f]))
+        total_tipped.append("%s%.2f" % (ctb.conf.fiat[f].symbol, totals['tipped']['fiat'][f]))
+    user_stats.append("\n")
+
+    user_stats.append("#### Total Tipped (Coins)\n\n")
+    user_stats.append("coin|total\n:---|---:\n")
+    for c in sorted(totals['tipped']['coin']):
+        user_stats.append("**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, totals['tipped']['coin'][c]))
+    user_stats.append("\n")
 
     # Total received
-    user_stats += "#### Total Received (Fiat)\n\n"
-    user_stats += "fiat|total\n:---|---:\n"
+    user_stats.append("#### Total Received (Fiat)\n\n")
+    user_stats.append("fiat|total\n:---|---:\n")
     total_received = []
-    for f in fiat:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_received_fiat, (username, f))
-        total_received_fiat = mysqlexec.fetchone()
-        if total_received_fiat['total_fiat'] != None:
-            user_stats += "**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, total_received_fiat['total_fiat'])
-            total_received.append("%s%.2f" % (ctb.conf.fiat[f].symbol, total_received_fiat['total_fiat']))
-    user_stats += "\n"
-
-    user_stats += "#### Total Received (Coins)\n\n"
-    user_stats += "coin|total\n:---|---:\n"
-    for c in coins:
-        mysqlexec = ctb.db.execute(ctb.conf.db.sql.userstats.total_received_coin, (username, c))
-        total_received_coin = mysqlexec.fetchone()
-        if total_received_coin['total_coin'] != None:
-            user_stats += "**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, total_received_coin['total_coin'])
-    user_stats += "\n"
-
-    # History
-    user_stats += "#### History\n\n"
-    history = ctb.db.execute(ctb.conf.db.sql.userstats.history, (username, username))
-    user_stats += ("|".join(history.keys())) + "\n"
-    user_stats += ("|".join([":---"] * len(history.keys()))) + "\n"
+    for f in sorted(totals['received']['fiat']):
+        user_stats.append("**%s**|%s %.2f\n" % (f, ctb.conf.fiat[f].symbol, totals['received']['fiat'][f]))
+        total_received.append("%s%.2f" % (ctb.conf.fiat[f].symbol, totals['received']['fiat'][f]))
+    user_stats.append("\n")
+
+    user_stats.append("#### Total Received (Coins)\n\n")
+    user_stats.append("coin|total\n:---|---:\n")
+    for c in sorted(totals['received']['coin']):
+        user_stats.append("**%s**|%s %.6f\n" % (c, ctb.conf.coins[c].symbol, totals['received']['coin'][c]))
+    user_stats.append("\n")
+
+    # History, most recent page only
+    user_stats.append("#### History\n\n")
+    history, cursor = get_history(ctb=ctb, username=username, columns=ctb.conf.db.sql.userstats.history_columns, types=ctb.conf.db.sql.userstats.history_types, limit=int(ctb.conf.db.sql.userstats.history_limit))
 
     # Build history table
-    num_tipped = 0
-    num_received = 0
-    for m in history:
-        if m['state'] == 'completed':
-            if m['from_user'].lower() == username.lower():
-                num_tipped += 1
-            elif m['to_user'].lower() == username.lower():
-                num_received += 1
-        values = []
-        for k in history.keys():
-            values.append(format_value(m, k, username, ctb))
-        user_stats += ("|".join(values)) + "\n"
+    render_table(user_stats, history, ctb.conf.db.sql.userstats.history_columns, username, ctb)
+    if cursor:
+        user_stats.append("\nShowing the %s most recent tips. /u/%s can list older ones with [+history %s](%s).\n" % (len(history), username, cursor, history_url(ctb=ctb, cursor=cursor)))
+    num_tipped = totals['tipped']['num']
+    num_received = totals['received']['num']
 
     # Submit changes
     lg.debug("update_user_stats(): updating subreddit '%s', page '%s'" % (ctb.conf.reddit.stats.subreddit, page))
-    ctb_misc.praw_call(ctb.reddit.edit_wiki_page, ctb.conf.reddit.stats.subreddit, page, user_stats, "Update by ALTcointip bot")
+    edit_wiki_page(ctb=ctb, page=page, content=''.join(user_stats))
 
     # Update user flair on subreddit
     if ctb.conf.reddit.stats.userflair and ( len(total_tipped) > 0 or len(total_received) > 0 ):
@@ -210,77 +418,197 @@ def update_user_stats(ctb=None, username=None):
                 flair += " / "
             flair += "received[" + '|'.join(total_received) + "]"
             flair += " (%d)" % num_received
+        # Flair has its own hash, as a failed flair update shouldn't be skipped next time
+        digest = content_hash(flair)
+        if is_published(ctb=ctb, page='flair:' + username.lower(), digest=digest):
+            lg.debug("update_user_stats(): flair for %s unchanged, skipping", username)
+            return True
         lg.debug("update_user_stats(): updating flair for %s (%s)", username, flair)
         r = ctb_misc.praw_call(ctb.reddit.get_subreddit, ctb.conf.reddit.stats.subreddit)
         res = ctb_misc.praw_call(r.set_flair, username, flair, '')
         lg.debug(res)
+        if res != False:
+            set_published(ctb=ctb, page='flair:' + username.lower(), digest=digest)
 
     return True
 
+class CtbUserStatsQueue(object):
+    """
+    Set of users whose stats pages are out of date. A background thread
+    rebuilds them every interval seconds, so each page is written at most
+    once per interval however many tips its user sends or receives.
+    """
+
+    ctb = None
+    interval = None
+
+    def __init__(self, ctb=None, interval=60):
+        self.ctb = ctb
+        self.interval = interval
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.marked = 0
+        self.written = 0
+
+    def mark(self, username):
+        """
+        Add username to set of users to update
+        """
+
+        with self.lock:
+            self.dirty.setdefault(username.lower(), username)
+            self.marked += 1
+
+    def flush(self):
+        """
+        Update stats of every user marked since last flush
+        """
+
+        with self.lock:
+            users = self.dirty.values()
+            self.dirty = {}
+
+        for u in sorted(users):
+            try:
+                update_user_stats(ctb=self.ctb, username=u)
+                self.written += 1
+            except Exception as e:
+                lg.error("CtbUserStatsQueue::flush(): error updating stats of %s: %s", u, e)
+
+        if users:
+            lg.debug("CtbUserStatsQueue::flush(): %s", self)
+
+    def start(self):
+        """
+        Start background thread calling flush() every self.interval seconds
+        """
+
+        def flusher():
+            while True:
+                time.sleep(self.interval)
+                self.flush()
+
+        t = threading.Thread(target=flusher, name='user_stats')
+        t.daemon = True
+        t.start()
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbUserStatsQueue: interval=%s, dirty=%s, marked=%s, updated=%s, pages written=%s, skipped=%s, failed=%s>"
+        me = me % (self.interval, len(self.dirty), self.marked, self.written, wiki_counts['written'], wiki_counts['skipped'], wiki_counts['failed'])
+        return me
+
+def render_table(out, rows, keys, username, ctb, compact=False):
+    """
+    Append markdown table of rows to list out, one string per line
+    """
+
+    plan = format_plan(keys, username, ctb, compact=compact)
+    out.append("|".join(keys) + "\n")
+    out.append("|".join([":---"] * len(keys)) + "\n")
+    for m in rows:
+        out.append("|".join([f(m) for f in plan]) + "\n")
+
+def format_plan(keys, username, ctb, compact=False):
+    """
+    Return list of functions formatting each of given columns of a row
+    """
+
+    return [column_formatter(k, username, ctb, compact=compact) for k in keys]
+
 def format_value(m, k, username, ctb, compact=False):
     """
     Format value for display based on its type
     m[k] is the value, k is the database row name
     """
 
-    if not m[k]:
-        return '-'
-
-    # Format cryptocoin
-    if type(m[k]) == float and k.find("coin") > -1:
-        coin_symbol = ctb.conf.coins[m['coin']].symbol
-        return "%s&nbsp;%.5g" % (coin_symbol, m[k])
+    return column_formatter(k, username, ctb, compact=compact)(m)
 
-    # Format fiat
-    elif type(m[k]) == float and ( k.find("fiat") > -1 or k.find("usd") > -1 ):
-        fiat_symbol = ctb.conf.fiat[m['fiat']].symbol
-        return "%s&nbsp;%.2f" % (fiat_symbol, m[k])
+def column_formatter(k, username, ctb, compact=False):
+    """
+    Return function formatting value of column k of a row for display.
+    Column name k is examined once here rather than for every row.
+    """
 
-    # Format username
-    elif k.find("user") > -1 and type( m[k] ) in [str, unicode]:
-        if compact:
-            return ("**/u/%s**" % m[k]) if m[k].lower() == username.lower() else ("/u/%s" % m[k])
-        else:
-            un = ("**%s**" % m[k]) if m[k].lower() == username.lower() else m[k]
-            toreturn = "[%s](/u/%s)" % (un, re.escape(m[k]))
-            if m[k].lower() != username.lower():
-                toreturn += "^[[stats]](/r/%s/wiki/%s_%s)" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page, m[k])
+    is_coin = k.find("coin") > -1
+    is_fiat = k.find("fiat") > -1 or k.find("usd") > -1
+    is_user = k.find("user") > -1
+    kind = None
+    for n in ['addr', 'state', 'type', 'subreddit', 'link', 'utc']:
+        if k.find(n) > -1:
+            kind = n
+            break
+
+    username = username.lower()
+    stats_link = "^[[stats]](/r/%s/wiki/%s_%%s)" % (ctb.conf.reddit.stats.subreddit, ctb.conf.reddit.stats.page)
+    coins = ctb.conf.coins
+    fiat = ctb.conf.fiat
+    check = unicode('✓', 'utf8')
+
+    def fmt(m):
+        v = m[k]
+
+        if not v:
+            return '-'
+
+        # Format cryptocoin
+        if is_coin and type(v) == float:
+            return "%s&nbsp;%.5g" % (coins[m['coin']].symbol, v)
+
+        # Format fiat
+        elif is_fiat and type(v) == float:
+            return "%s&nbsp;%.2f" % (fiat[m['fiat']].symbol, v)
+
+        # Format username
+        elif is_user and type(v) in [str, unicode]:
+            mine = v.lower() == username
+            if compact:
+                return ("**/u/%s**" % v) if mine else ("/u/%s" % v)
+            un = ("**%s**" % v) if mine else v
+            toreturn = "[%s](/u/%s)" % (un, re.escape(v))
+            if not mine:
+                toreturn += stats_link % v
             return toreturn
 
-    # Format address
-    elif k.find("addr") > -1:
-        displayaddr = m[k][:6] + "..." + m[k][-5:]
-        return "[%s](%s%s)" % (displayaddr, ctb.conf.coins[m['coin']].explorer.address, m[k])
-
-    # Format state
-    elif k.find("state") > -1:
-        if m[k] == 'completed':
-            return unicode('✓', 'utf8')
+        # Format address
+        elif kind == 'addr':
+            displayaddr = v[:6] + "..." + v[-5:]
+            return "[%s](%s%s)" % (displayaddr, coins[m['coin']].explorer.address, v)
+
+        # Format state
+        elif kind == 'state':
+            if v == 'completed':
+                return check
+            else:
+                return v
+
+        # Format type
+        elif kind == 'type':
+            if v == 'givetip':
+                return 'tip'
+            if compact:
+                if v == 'withdraw':
+                    return 'w'
+                if v == 'redeem':
+                    return 'r'
+            return v
+
+        # Format subreddit
+        elif kind == 'subreddit':
+            return "/r/%s" % v
+
+        # Format link
+        elif kind == 'link':
+            return "[link](%s)" % v
+
+        # Format time
+        elif kind == 'utc':
+            return "%s" % time.strftime('%Y-%m-%d', time.localtime(v))
+
+        # It's something else
         else:
-            return m[k]
-
-    # Format type
-    elif k.find("type") > -1:
-        if m[k] == 'givetip':
-            return 'tip'
-        if compact:
-            if m[k] == 'withdraw':
-                return 'w'
-            if m[k] == 'redeem':
-                return 'r'
-
-    # Format subreddit
-    elif k.find("subreddit") > -1:
-        return "/r/%s" % m[k]
-
-    # Format link
-    elif k.find("link") > -1:
-        return "[link](%s)" % m[k]
-
-    # Format time
-    elif k.find("utc") > -1:
-        return "%s" % time.strftime('%Y-%m-%d', time.localtime(m[k]))
-
-    # It's something else
-    else:
-        return str(m[k])
+            return str(v)
+
+    return fmt
@@ -17,7 +17,8 @@
 
 import ctb_misc
 
-import logging, time, praw, re
+import logging, time, praw, re, threading
+from collections import OrderedDict
 
 lg = logging.getLogger('cointipbot')
 
@@ -37,7 +38,10 @@ class CtbUser(object):
     prawobj=None
     ctb=None
 
-    def __init__(self, name=None, redditobj=None, ctb=None):
+    # How long looked up attributes stay valid, in seconds (None: for life of object)
+    ttl={'registered': 0, 'addr': 0, 'prawobj': None, 'karma': None}
+
+    def __init__(self, name=None, redditobj=None, ctb=None, ttl=None):
         """
         Initialize CtbUser object with given parameters
         """
@@ -51,21 +55,19 @@ class CtbUser(object):
             raise Exception("CtbUser::__init__(): ctb must be set")
         self.ctb = ctb
 
+        if ttl:
+            self.ttl = ttl
+        self.checked = {}
+        self.registered = None
+        self.karma = None
+
         if bool(redditobj):
             self.prawobj = redditobj
+            self.touch('prawobj')
 
         # Determine if user is banned
-        if ctb.conf.reddit.banned_users:
-            if ctb.conf.reddit.banned_users.method == 'subreddit':
-                for u in ctb.reddit.get_banned(ctb.conf.reddit.banned_users.subreddit):
-                    if self.name.lower() == u.name.lower():
-                        self.banned = True
-            elif ctb.conf.reddit.banned_users.method == 'list':
-                for u in ctb.conf.reddit.banned_users.list:
-                    if self.name.lower() == u.lower():
-                        self.banned = True
-            else:
-                lg.warning("CtbUser::__init__(): invalid method '%s' in banned_users config" % ctb.conf.reddit.banned_users.method)
+        if ctb.banned:
+            self.banned = ctb.banned.is_banned(self.name)
 
         lg.debug("< CtbUser::__init__(%s) DONE", name)
 
@@ -77,6 +79,24 @@ class CtbUser(object):
         me = me % (self.name, self.giftamount, self.joindate, self.addr, self.prawobj, self.ctb, self.banned)
         return me
 
+    def fresh(self, attr):
+        """
+        Return True if attr was looked up less than self.ttl[attr] seconds ago
+        """
+
+        if not self.checked.has_key(attr):
+            return False
+        if self.ttl.get(attr) == None:
+            return True
+        return time.time() - self.checked[attr] < self.ttl[attr]
+
+    def touch(self, attr):
+        """
+        Mark attr as just looked up
+        """
+
+        self.checked[attr] = time.time()
+
     def get_balance(self, coin=None, kind=None):
         """
         If coin is specified, return float with coin balance for user. Else, return a dict with balance of each coin for user.
@@ -99,21 +119,28 @@ class CtbUser(object):
         """
         lg.debug("> CtbUser::get_addr(%s, %s)", self.name, coin)
 
-        if hasattr(self.addr, coin):
-            return self.addr[coin]
+        addr = self.get_addrs().get(coin.lower())
 
-        sql = "SELECT address from t_addrs WHERE username = %s AND coin = %s"
-        mysqlrow = self.ctb.db.execute(sql, (self.name.lower(), coin.lower())).fetchone()
-        if mysqlrow == None:
-            lg.debug("< CtbUser::get_addr(%s, %s) DONE (no)", self.name, coin)
-            return None
-        else:
-            self.addr[coin] = mysqlrow['address']
-            lg.debug("< CtbUser::get_addr(%s, %s) DONE (%s)", self.name, coin, self.addr[coin])
-            return self.addr[coin]
+        lg.debug("< CtbUser::get_addr(%s, %s) DONE (%s)", self.name, coin, addr)
+        return addr
 
-        lg.debug("< CtbUser::get_addr(%s, %s) DONE (should never happen)", self.name, coin)
-        return None
+    def get_addrs(self):
+        """
+        Return dict of coin addresses of user, loading all of them with one query when older than ttl
+        """
+
+        if not self.fresh('addr'):
+            addr = {}
+            sql = "SELECT coin, address FROM t_addrs WHERE username = %s"
+            for mysqlrow in self.ctb.db.execute(sql, (self.name.lower())):
+                addr[mysqlrow['coin']] = mysqlrow['address']
+            self.addr = addr
+            self.touch('addr')
+            if self.ctb.addrs:
+                for c in addr:
+                    self.ctb.addrs.add(self.name, c, addr[c])
+
+        return self.addr
 
     def is_on_reddit(self):
         """
@@ -122,13 +149,16 @@ class CtbUser(object):
         lg.debug("> CtbUser::is_on_reddit(%s)", self.name)
 
         # Return true if prawobj is already set
-        if bool(self.prawobj):
+        if bool(self.prawobj) and self.fresh('prawobj'):
             lg.debug("< CtbUser::is_on_reddit(%s) DONE (yes)", self.name)
             return True
 
         try:
-            self.prawobj = ctb_misc.praw_call(self.ctb.reddit.get_redditor, self.name)
-            if self.prawobj:
+            # Assigned only once fetched, as other threads may be using prawobj of same CtbUser
+            prawobj = ctb_misc.praw_call(self.ctb.reddit.get_redditor, self.name)
+            if prawobj:
+                self.prawobj = prawobj
+                self.touch('prawobj')
                 return True
             else:
                 return False
@@ -146,12 +176,18 @@ class CtbUser(object):
         """
         lg.debug("> CtbUser::is_registered(%s)", self.name)
 
+        if self.fresh('registered'):
+            lg.debug("< CtbUser::is_registered(%s) DONE (%s, cached)", self.name, self.registered)
+            return self.registered
+
         try:
             # First, check t_users table
             sql = "SELECT * FROM t_users WHERE username = %s"
             mysqlrow = self.ctb.db.execute(sql, (self.name.lower())).fetchone()
 
             if mysqlrow == None:
+                self.registered = False
+                self.touch('registered')
                 lg.debug("< CtbUser::is_registered(%s) DONE (no)", self.name)
                 return False
 
@@ -167,6 +203,8 @@ class CtbUser(object):
                         lg.warning("CtbUser::is_registered(%s): deleting user, incomplete registration", self.name)
                         sql_delete = "DELETE FROM t_users WHERE username = %s"
                         mysql_res = self.ctb.db.execute(sql_delete, (self.name.lower()))
+                        if self.ctb.users:
+                            self.ctb.users.invalidate(self.name)
                         # User is not registered
                         return False
                     else:
@@ -174,6 +212,8 @@ class CtbUser(object):
 
                 # Set some properties
                 self.giftamount = mysqlrow['giftamount']
+                self.registered = True
+                self.touch('registered')
 
                 # Done
                 lg.debug("< CtbUser::is_registered(%s) DONE (yes)", self.name)
@@ -214,40 +254,70 @@ class CtbUser(object):
         """
         lg.debug("> CtbUser::register(%s)", self.name)
 
-        # Add user to database
+        # User and its coin addresses are added together, or not at all
+        sql_adduser = "INSERT INTO t_users (username) VALUES (%s)"
+        sql_deladdr = "DELETE FROM t_addrs WHERE username = %s"
+        sql_addr = "INSERT INTO t_addrs (username, coin, address) VALUES (%s, %s, %s)"
+        new_addrs = {}
         try:
-            sql_adduser = "INSERT INTO t_users (username) VALUES (%s)"
-            mysqlexec = self.ctb.db.execute(sql_adduser, (self.name.lower()))
-            if mysqlexec.rowcount <= 0:
-                raise Exception("CtbUser::register(%s): rowcount <= 0 while executing <%s>" % ( self.name, sql_adduser % (self.name.lower()) ))
-        except Exception, e:
-            lg.error("CtbUser::register(%s): exception while executing <%s>: %s", self.name, sql_adduser % (self.name.lower()), e)
-            raise
+            # Get new coin addresses first, so no transaction is held open while coin daemons answer
+            for c in self.ctb.coins:
+                new_addrs[c] = self.ctb.coins[c].getnewaddr(_user=self.name.lower())
+                lg.info("CtbUser::register(%s): got %s address %s", self.name, c, new_addrs[c])
 
-        # Get new coin addresses
-        new_addrs = {}
-        for c in self.ctb.coins:
-            new_addrs[c] = self.ctb.coins[c].getnewaddr(_user=self.name.lower())
-            lg.info("CtbUser::register(%s): got %s address %s", self.name, c, new_addrs[c])
-
-        # Add coin addresses to database
-        for c in new_addrs:
-            try:
-                sql_addr = "REPLACE INTO t_addrs (username, coin, address) VALUES (%s, %s, %s)"
-                mysqlexec = self.ctb.db.execute(sql_addr, (self.name.lower(), c, new_addrs[c]))
+            with self.ctb.db.begin() as conn:
+                mysqlexec = conn.execute(sql_adduser, (self.name.lower()))
                 if mysqlexec.rowcount <= 0:
-                    # Undo change to database
-                    delete_user(_username=self.name.lower(), _db=self.ctb.db)
-                    raise Exception("CtbUser::register(%s): rowcount <= 0 while executing <%s>" % (self.name, sql_addr % (self.name.lower(), c, new_addrs[c])))
+                    raise Exception("CtbUser::register(%s): rowcount <= 0 while executing <%s>" % ( self.name, sql_adduser % (self.name.lower()) ))
+
+                # Add coin addresses to database in one statement, replacing any left by an incomplete registration
+                if new_addrs:
+                    conn.execute(sql_deladdr, (self.name.lower()))
+                    mysqlexec = conn.execute(sql_addr, [(self.name.lower(), c, new_addrs[c]) for c in new_addrs])
+                    if mysqlexec.rowcount <= 0:
+                        raise Exception("CtbUser::register(%s): rowcount <= 0 while adding %s addresses" % (self.name, len(new_addrs)))
+
+        except Exception, e:
+            lg.error("CtbUser::register(%s): error adding user: %s", self.name, e)
+            raise
 
-            except Exception, e:
-                # Undo change to database
-                delete_user(_username=self.name.lower(), _db=self.ctb.db)
-                raise
+        # Drop cached copy that may say user isn't registered
+        if self.ctb.users:
+            self.ctb.users.invalidate(self.name)
+        self.addr = new_addrs
+        self.touch('addr')
+        if self.ctb.addrs:
+            for c in new_addrs:
+                self.ctb.addrs.add(self.name, c, new_addrs[c])
+        self.registered = True
+        self.touch('registered')
 
         lg.debug("< CtbUser::register(%s) DONE", self.name)
         return True
 
+    def get_karma(self):
+        """
+        Return (link_karma, comment_karma) of user, reloading Redditor object when karma is older than ttl
+        """
+
+        if not self.fresh('karma'):
+            if self.checked.has_key('karma'):
+                # Karma is stale, fetch Redditor again (prawobj is replaced only once fetched, as other threads may be using it)
+                prawobj = ctb_misc.praw_call(self.ctb.reddit.get_redditor, self.name)
+                if not prawobj:
+                    raise Exception("CtbUser::get_karma(%s): not a Reddit user" % self.name)
+                karma = (int(prawobj.link_karma), int(prawobj.comment_karma))
+                self.prawobj = prawobj
+                self.touch('prawobj')
+            else:
+                if not self.is_on_reddit():
+                    raise Exception("CtbUser::get_karma(%s): not a Reddit user" % self.name)
+                karma = (int(self.prawobj.link_karma), int(self.prawobj.comment_karma))
+            self.karma = karma
+            self.touch('karma')
+
+        return self.karma
+
     def get_redeem_amount(self, coin=None, fiat=None):
         """
         Return karma redeem amount for a given coin
@@ -271,7 +341,7 @@ class CtbUser(object):
             link_mul = eval(link_mul)
         if not type(link_mul) == float:
             raise Exception("CtbUser::get_redeem_amount(): type of link_mul is not float")
-        link_val = float(self.prawobj.link_karma) * link_mul
+        link_val = float(self.get_karma()[0]) * link_mul
 
         # Second, determine fiat value due to comment karma
         comm_mul = self.ctb.conf.reddit.redeem.multiplier.comment
@@ -279,7 +349,7 @@ class CtbUser(object):
             comm_mul = eval(comm_mul)
         if not type(comm_mul) == float:
             raise Exception("CtbUser::get_redeem_amount(): type of comm_mul is not float")
-        comm_val = float(self.prawobj.comment_karma) * comm_mul
+        comm_val = float(self.get_karma()[1]) * comm_mul
 
         # Third, determine base fiat value from config
         base_val = self.ctb.conf.reddit.redeem.base
@@ -302,19 +372,243 @@ class CtbUser(object):
         return (total_coin, total_fiat)
 
 
-def delete_user(_username=None, _db=None):
+class CtbBannedUsers(object):
+    """
+    Lowercase set of banned usernames, from banned_users config list or
+    from ban list of banned_users subreddit. Subreddit ban list is loaded
+    on first lookup and refreshed in background once older than ttl seconds.
+    A failed load isn't tried again for retry seconds (or ttl, if shorter).
+    """
+
+    ctb = None
+    method = None
+    ttl = None
+    retry = 300
+
+    def __init__(self, ctb=None, ttl=3600):
+        self.ctb = ctb
+        self.method = ctb.conf.reddit.banned_users.method
+        self.ttl = ttl
+        self.names = None
+        self.loaded = 0
+        self.retry_after = 0
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+        if not self.method in ['subreddit', 'list']:
+            lg.warning("CtbBannedUsers::__init__(): invalid method '%s' in banned_users config" % self.method)
+
+    def refresh(self):
+        """
+        Load set of banned usernames
+        """
+        lg.debug("> CtbBannedUsers::refresh(%s)", self.method)
+
+        names = set()
+        try:
+            if self.method == 'subreddit':
+                for u in ctb_misc.praw_call(self.ctb.reddit.get_banned, self.ctb.conf.reddit.banned_users.subreddit):
+                    names.add(u.name.lower())
+            elif self.method == 'list':
+                for u in self.ctb.conf.reddit.banned_users.list:
+                    names.add(u.lower())
+        except Exception as e:
+            lg.error("CtbBannedUsers::refresh(): error loading banned users: %s", e)
+            self.retry_after = time.time() + min(self.retry, self.ttl)
+            if self.names != None:
+                # Keep using previous list
+                return False
+            raise
+        finally:
+            self.refreshing = False
+
+        self.names = frozenset(names)
+        self.loaded = time.time()
+
+        lg.debug("< CtbBannedUsers::refresh() DONE (%s users)", len(names))
+        return True
+
+    def is_banned(self, name):
+        """
+        Return True if name is banned
+        """
+
+        with self.lock:
+            if self.names == None:
+                if time.time() < self.retry_after:
+                    raise Exception("CtbBannedUsers::is_banned(%s): banned users not loaded, retrying in %d s" % (name, self.retry_after - time.time()))
+                self.refresh()
+            elif self.method == 'subreddit' and time.time() - self.loaded > self.ttl and time.time() >= self.retry_after and not self.refreshing:
+                self.refreshing = True
+                t = threading.Thread(target=self.refresh, name='banned_users')
+                t.daemon = True
+                t.start()
+
+        return name.lower() in self.names
+
+class CtbUserMap(object):
     """
-    Delete _username from t_users and t_addrs tables
+    Bounded LRU map of CtbUser objects by lowercase username, so the same
+    user's registration, addresses, Redditor object and karma are looked
+    up once per ttl instead of once per CtbUser
+    """
+
+    ctb = None
+    size = None
+    ttl = None
+
+    def __init__(self, ctb=None, size=1000, ttl=None):
+        self.ctb = ctb
+        self.size = int(size)
+        self.ttl = dict(CtbUser.ttl)
+        if ttl:
+            self.ttl.update(ttl)
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, redditobj=None):
+        """
+        Return CtbUser for name, creating it if not in map
+        """
+
+        key = name.lower()
+        with self.lock:
+            u = self.users.pop(key, None)
+            if u:
+                self.hits += 1
+            else:
+                self.misses += 1
+                u = CtbUser(name=name, redditobj=redditobj, ctb=self.ctb, ttl=self.ttl)
+            self.users[key] = u
+            while len(self.users) > self.size:
+                self.users.popitem(last=False)
+
+        if redditobj and not u.fresh('prawobj'):
+            u.prawobj = redditobj
+            u.touch('prawobj')
+        if self.ctb.banned:
+            u.banned = self.ctb.banned.is_banned(name)
+        return u
+
+    def invalidate(self, name):
+        """
+        Drop name from map
+        """
+
+        with self.lock:
+            self.users.pop(name.lower(), None)
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbUserMap: size=%s/%s, hits=%s, misses=%s>"
+        me = me % (len(self.users), self.size, self.hits, self.misses)
+        return me
+
+class CtbAddrIndex(object):
+    """
+    Process-wide index of coin addresses to lowercase usernames, loaded from
+    t_addrs with one query on first lookup and reloaded once older than ttl
+    seconds. Addresses handed out or looked up by this process are added
+    as they're seen.
+    """
+
+    ctb = None
+    ttl = None
+
+    def __init__(self, ctb=None, ttl=3600):
+        self.ctb = ctb
+        self.ttl = ttl
+        self.owners = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Load index from t_addrs
+        """
+        lg.debug("> CtbAddrIndex::refresh()")
+
+        owners = {}
+        sql = "SELECT username, coin, address FROM t_addrs"
+        for mysqlrow in self.ctb.db.execute(sql):
+            owners.setdefault(mysqlrow['coin'], {})[mysqlrow['address']] = mysqlrow['username'].lower()
+        self.owners = owners
+        self.loaded = time.time()
+
+        lg.debug("< CtbAddrIndex::refresh() DONE (%s addresses)", sum([len(owners[c]) for c in owners]))
+        return True
+
+    def lookup(self, coin, address):
+        """
+        Return lowercase username owning coin address, or None if it isn't one of ours
+        """
+
+        with self.lock:
+            if self.owners == None or time.time() - self.loaded > self.ttl:
+                self.refresh()
+            return self.owners.get(coin.lower(), {}).get(address)
+
+    def add(self, username, coin, address):
+        """
+        Record address as belonging to username
+        """
+
+        with self.lock:
+            if self.owners != None:
+                self.owners.setdefault(coin.lower(), {})[address] = username.lower()
+
+    def remove(self, username):
+        """
+        Forget all addresses of username
+        """
+
+        username = username.lower()
+        with self.lock:
+            if self.owners != None:
+                for c in self.owners:
+                    for a in [a for a in self.owners[c] if self.owners[c][a] == username]:
+                        del self.owners[c][a]
+
+    def __str__(self):
+        """
+        Return string representation of self
+        """
+        me = "<CtbAddrIndex: addresses=%s, loaded=%s>"
+        me = me % (sum([len(self.owners[c]) for c in self.owners]) if self.owners else 0, self.loaded)
+        return me
+
+def get_user(name=None, redditobj=None, ctb=None):
+    """
+    Return CtbUser for name from ctb.users, or a new CtbUser if there's no map
+    """
+
+    if ctb.users:
+        return ctb.users.get(name, redditobj=redditobj)
+    return CtbUser(name=name, redditobj=redditobj, ctb=ctb)
+
+def delete_user(_username=None, _db=None, _ctb=None):
+    """
+    Delete _username from t_users and t_addrs tables, and from _ctb.users if given
     """
     lg.debug("> delete_user(%s)", _username)
 
+    if _ctb and _ctb.users:
+        _ctb.users.invalidate(_username)
+    if _ctb and _ctb.addrs:
+        _ctb.addrs.remove(_username)
+
     try:
         sql_arr = ["DELETE FROM t_users WHERE username = %s",
                    "DELETE FROM t_addrs WHERE username = %s"]
-        for sql in sql_arr:
-            mysqlexec = _db.execute(sql, _username.lower())
-            if mysqlexec.rowcount <= 0:
-                lg.warning("delete_user(%s): rowcount <= 0 while executing <%s>", _username, sql % _username.lower())
+        with _db.begin() as conn:
+            for sql in sql_arr:
+                mysqlexec = conn.execute(sql, _username.lower())
+                if mysqlexec.rowcount <= 0:
+                    lg.warning("delete_user(%s): rowcount <= 0 while executing <%s>", _username, sql % _username.lower())
 
     except Exception, e:
         lg.error("delete_user(%s): error while executing <%s>: %s", _username, sql % _username.lower(), e)
@@ -0,0 +1,99 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+
+    Run from src directory: python -m unittest discover tests
+"""
+
+import os, shutil, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ctb import ctb_db, ctb_stats
+
+class FakeCtb(object):
+    """
+    Just enough of CointipBot for history to be read
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ctb_db.CointipBotDatabase('sqlite:///' + os.path.join(self.dir, 'ctb.db')).connect()
+        self.ctb = FakeCtb(self.db)
+
+        # Actions of alice spread over t_action and t_action_archive, several sharing a created_utc,
+        # plus a tip to herself, others' tips and an action type that isn't listed
+        self.expected = []
+        n = 0
+        with self.db.begin() as conn:
+            for created_utc in [1000, 1000, 1000, 1001, 1002, 1002, 1003, 1005, 1005, 1005, 1005, 1006]:
+                for table in ['t_action', 't_action_archive']:
+                    n += 1
+                    msg_id = 'm%03d' % n
+                    from_user, to_user = [('alice', 'bob'), ('bob', 'alice'), ('carol', 'bob')][n % 3]
+                    if n == 7:
+                        from_user, to_user = ('alice', 'alice')
+                    self.add(conn, table, msg_id, created_utc, from_user, to_user)
+                    if 'alice' in [from_user, to_user]:
+                        self.expected.append((created_utc, msg_id))
+            self.add(conn, 't_action', 'x001', 1004, 'alice', None, atype='info')
+        self.expected.sort(reverse=True)
+
+    def tearDown(self):
+        self.db.dispose()
+        shutil.rmtree(self.dir)
+
+    def add(self, conn, table, msg_id, created_utc, from_user, to_user, atype='givetip'):
+        conn.execute("INSERT INTO " + table + " (type, state, created_utc, from_user, to_user, coin, coin_val, msg_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+                     (atype, 'completed', created_utc, from_user, to_user, 'dog', 1.0, msg_id))
+
+    def pages(self, limit):
+        found = []
+        cursors = []
+        cursor = None
+        while True:
+            rows, cursor = ctb_stats.get_history(ctb=self.ctb, username='Alice', columns=['type', 'from_user', 'to_user'], types=['givetip'], limit=limit, cursor=cursor)
+            self.assertTrue(len(rows) <= limit)
+            found += [(m['created_utc'], m['msg_id']) for m in rows]
+            cursors.append(cursor)
+            if not cursor:
+                return found, cursors
+            self.assertEqual(len(rows), limit)
+            self.assertTrue(len(cursors) <= len(self.expected))
+
+    def test_pages(self):
+        for limit in [1, 2, 3, 5, len(self.expected) - 1, len(self.expected), 100]:
+            found, cursors = self.pages(limit)
+            self.assertEqual(found, self.expected, "limit %s" % limit)
+            self.assertEqual(cursors[-1], None)
+
+    def test_self_tip_once(self):
+        found, cursors = self.pages(100)
+        self.assertEqual(len([f for f in found if f[1] == 'm007']), 1)
+        self.assertEqual(len(cursors), 1)
+
+    def test_cursor(self):
+        rows, cursor = ctb_stats.get_history(ctb=self.ctb, username='alice', columns=['type'], types=['givetip'], limit=2)
+        self.assertEqual(cursor, ctb_stats.format_cursor(rows[-1]))
+        self.assertEqual(ctb_stats.parse_cursor(cursor), (rows[-1]['created_utc'], rows[-1]['msg_id']))
+        self.assertEqual(ctb_stats.parse_cursor('not a cursor'), None)
+
+if __name__ == '__main__':
+    unittest.main()
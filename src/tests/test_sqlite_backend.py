@@ -0,0 +1,86 @@
+"""
+    This file is part of ALTcointip.
+
+    ALTcointip is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    ALTcointip is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with ALTcointip.  If not, see <http://www.gnu.org/licenses/>.
+
+    Run from src directory: python -m unittest discover tests
+"""
+
+import os, shutil, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ctb import ctb_action, ctb_db
+
+class FakeCtb(object):
+    """
+    Just enough of CointipBot for actions to be saved and loaded
+    """
+
+    conf = None
+    users = None
+    addrs = None
+    banned = None
+    seen = None
+
+    def __init__(self, db):
+        self.db = db
+
+class TestSqliteBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = ctb_db.CointipBotDatabase('sqlite:///' + os.path.join(self.dir, 'ctb.db')).connect()
+        self.ctb = FakeCtb(self.db)
+
+    def tearDown(self):
+        self.db.dispose()
+        shutil.rmtree(self.dir)
+
+    def save_tip(self, msg_id, state, created_utc=1400000000):
+        a = ctb_action.CtbAction(atype='givetip', deleted_msg_id=msg_id, deleted_created_utc=created_utc, from_user='Alice', to_user='bob', coin='dog', fiat='usd', coin_val=100.0, fiat_val=0.05, subr='dogecoin', ctb=self.ctb)
+        self.assertTrue(a.save(state))
+        return a
+
+    def test_get_actions(self):
+        self.save_tip('abc1', 'pending')
+        self.save_tip('abc2', 'completed')
+
+        actions = ctb_action.get_actions(atype='givetip', state='pending', ctb=self.ctb)
+        self.assertEqual(len(actions), 1)
+        a = actions[0]
+        self.assertEqual(a.msg.id, 'abc1')
+        self.assertEqual(a.u_from.name, 'alice')
+        self.assertEqual(a.u_to.name, 'bob')
+        self.assertEqual(a.coin, 'dog')
+        self.assertEqual(a.coinval, 100.0)
+        self.assertEqual(a.subreddit, 'dogecoin')
+
+    def test_get_actions_none(self):
+        self.save_tip('abc1', 'completed')
+        self.assertEqual(ctb_action.get_actions(atype='givetip', state='pending', ctb=self.ctb), [])
+
+    def test_set_actions_state_from_state(self):
+        self.save_tip('abc1', 'pending')
+        self.save_tip('abc2', 'completed')
+        actions = ctb_action.get_actions(atype='givetip', ctb=self.ctb)
+        self.assertEqual(len(actions), 2)
+
+        claimed = ctb_action.set_actions_state(actions, 'expired', ctb=self.ctb, from_state='pending')
+        self.assertEqual([a.msg.id for a in claimed], ['abc1'])
+        self.assertEqual(ctb_action.set_actions_state(actions, 'expired', ctb=self.ctb, from_state='pending'), [])
+        self.assertEqual(len(ctb_action.get_actions(atype='givetip', state='expired', ctb=self.ctb)), 1)
+
+if __name__ == '__main__':
+    unittest.main()
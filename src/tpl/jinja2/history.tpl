@@ -1,6 +1,10 @@
 {% set user = a.u_from.name %}
 
+{% if cursor %}
+Hello {{ user | replace('_', '\_') }}, here are up to {{ limit }} more of your transactions.
+{% else %}
 Hello {{ user | replace('_', '\_') }}, here are your last {{ limit }} transactions.
+{% endif %}
 
 {{ "|".join(keys) }}
 {{ "|".join([":---"] * (keys|length)) }}
@@ -8,4 +12,14 @@ Hello {{ user | replace('_', '\_') }}, here are your last {{ limit }} transactio
 {{   "|".join(h) }}
 {% endfor %}
 
+{% if next_cursor %}
+__[Older transactions]({{ older_url }})__ (send __+history {{ next_cursor }}__)
+
+{% endif %}
+{% for d in ['tipped', 'received'] %}
+{%   if totals[d].num %}
+Total {{ d }}: __{% for f in totals[d].fiat|sort %}{{ "%s%.2f" % (ctb.conf.fiat[f].symbol, totals[d].fiat[f]) }}{% if not loop.last %} + {% endif %}{% endfor %}__ in {{ totals[d].num }} tips
+
+{%   endif %}
+{% endfor %}
 {% include 'footer.tpl' %}
@@ -0,0 +1,4 @@
+{% set user_from = a.u_from.name %}
+Sorry {{ user_from | replace('_', '\_') }}, I couldn't work out how much {{ a.coin | upper }} your {{ a.fiat | upper }} tip is worth, because exchange rates aren't available right now. Please try again later, or tip an amount in {{ a.coin | upper }}.
+
+{% include 'footer.tpl' %}
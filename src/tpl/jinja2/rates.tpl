@@ -11,5 +11,6 @@ coin|average{% for e in exchanges %}{{ "|" + e }}{% endfor %}
 {%   endfor %}
 {% endfor %}
 
+Rates as of {{ refreshed }} UTC.
 
 {% include 'footer.tpl' %}